@@ -1,69 +1,224 @@
 # -*- coding: utf8 -*-
 
+import html.parser
 import logging
-import bs4
+import os.path
+import re
+import sys
+
 from pelican import signals
-from pelican.generators import ArticlesGenerator, PagesGenerator
+from pelican.readers import MarkdownReader
+
+try:
+    from markdown.extensions import Extension
+    from markdown.treeprocessors import Treeprocessor
+except ImportError:
+    # Only needed in markdown mode
+    Extension = Treeprocessor = object
+
+try:
+    import gio_common
+except ImportError:
+    # PLUGIN_PATHS isn't on sys.path, so find gio_common next to this plugin
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    import gio_common
+from gio_common import pipeline
 
 IGNORE_VAR_NAME = "ANCHORLINKS_IGNORE"
 DEFAULT_IGNORE = ["footnote-ref", "toclink"]
 
-def process_content(article):
+MODE_VAR_NAME = "ANCHORLINKS_MODE"
+MODE_STREAM = "stream"
+MODE_SOUP = "soup"
+MODE_MARKDOWN = "markdown"
+DEFAULT_MODE = MODE_STREAM
+
+ANCHORLINK_CLASS = "anchorlink"
+
+# After toc (5), which adds its own links, and before unescaping (0)
+TREEPROCESSOR_PRIORITY = 3
+
+# Cheap test for documents that can't have anything to do
+MAYBE_ANCHOR_RE = re.compile(r'''href\s*=\s*["']?#''', re.IGNORECASE)
+
+# One attribute of a raw start tag, as html.parser's tolerant attribute regex
+ATTR_RE = re.compile(
+    r'''((?<=['"\s/])[^\s/>][^\s/=>]*)(\s*=+\s*('[^']*'|"[^"]*"|(?!['"])[^>\s]*))?(?:\s|/(?!>))*'''
+)
+
+
+def is_anchorlink(attrs, ignore_tags):
+    # Duplicate attributes: the last one wins, as with bs4
+    attrs = dict(attrs)
+    if not (attrs.get('href') or '').startswith("#"):
+        return False
+    tag_class = (attrs.get('class') or '').split()
+    return not any(c in tag_class for c in ignore_tags)
+
+
+def class_with_anchorlink(value):
+    return f"{value} {ANCHORLINK_CLASS}" if value and value.strip() else ANCHORLINK_CLASS
+
+
+def add_class(tag_text):
+    """Add the anchorlink class to a raw start tag, leaving the rest of it alone"""
+    last_class = None
+    for match in ATTR_RE.finditer(tag_text, 2):
+        if match.group(1).lower() == 'class' and match.group(3) is not None:
+            last_class = match
+
+    if last_class is None:
+        end = len(tag_text) - (2 if tag_text.endswith("/>") else 1)
+        end = len(tag_text[:end].rstrip())
+        return f'{tag_text[:end]} class="{ANCHORLINK_CLASS}"{tag_text[end:]}'
+
+    start, end = last_class.span(3)
+    value = last_class.group(3)
+    quote = value[0] if value[:1] in ("'", '"') else ''
+    value = value[1:-1] if quote else value
+    value = class_with_anchorlink(value)
+    quote = quote or '"'
+    return f"{tag_text[:start]}{quote}{value}{quote}{tag_text[end:]}"
+
+
+class AnchorRewriter(html.parser.HTMLParser):
     """
-    Pelican callback
+    Finds the start tags of anchor links, and edits just those, copying the
+    rest of the document as it was.
     """
 
-    # TODO: This is too slow
+    def __init__(self, ignore_tags):
+        super().__init__(convert_charrefs=False)
+        self.ignore_tags = ignore_tags
+        self.edits = []
 
-    if article._content is None:
-        logging.warning(f"{article.title} is empty!")
-        return
+    def handle_starttag(self, tag, attrs):
+        if tag == "a" and is_anchorlink(attrs, self.ignore_tags):
+            line, column = self.getpos()
+            self.edits.append((line, column, self.get_starttag_text()))
 
-    dirty = False
-    settings = article.settings
-    ignore_tags = settings.get(IGNORE_VAR_NAME, DEFAULT_IGNORE)
-    
-    soup_doc = bs4.BeautifulSoup(article._content, 'html.parser')
+    def rewrite(self, content):
+        self.feed(content)
+        self.close()
+        if not self.edits:
+            return None
+
+        # getpos counts lines by "\n" alone
+        line_starts = [0]
+        line_starts.extend(m.end() for m in re.finditer("\n", content))
+
+        parts = []
+        last = 0
+        for line, column, tag_text in self.edits:
+            start = line_starts[line - 1] + column
+            parts.append(content[last:start])
+            parts.append(add_class(tag_text))
+            last = start + len(tag_text)
+        parts.append(content[last:])
+        return "".join(parts)
+
+
+def rewrite_content(content, ignore_tags=DEFAULT_IGNORE):
+    """
+    Return `content` with the anchorlink class added to its anchor links, or
+    None if there were none.
+    """
+    if not MAYBE_ANCHOR_RE.search(content):
+        return None
+    return AnchorRewriter(ignore_tags).rewrite(content)
 
-    for anchor in soup_doc.findAll("a", href=True):
-        if anchor['href'].startswith("#"):
+
+class AnchorlinksTreeprocessor(Treeprocessor):
+    """
+    Adds the anchorlink class while the document is still an ElementTree,
+    including raw html that's been stashed away from the tree
+    """
+
+    def __init__(self, md, ignore_tags):
+        super().__init__(md)
+        self.ignore_tags = ignore_tags
+
+    def mark(self, root):
+        for anchor in root.iter('a'):
+            if is_anchorlink(anchor.items(), self.ignore_tags):
+                anchor.set('class', class_with_anchorlink(anchor.get('class')))
+
+    def run(self, root):
+        self.mark(root)
+
+        blocks = self.md.htmlStash.rawHtmlBlocks
+        for i, block in enumerate(blocks):
+            if isinstance(block, str):
+                content = rewrite_content(block, self.ignore_tags)
+                if content is not None:
+                    blocks[i] = content
+            else:
+                self.mark(block)
+
+
+class AnchorlinksExtension(Extension):
+    def __init__(self, **kwargs):
+        self.config = {
+            'ignore': [DEFAULT_IGNORE, "Links with any of these classes are left alone"],
+        }
+        super().__init__(**kwargs)
+
+    def extendMarkdown(self, md):
+        md.treeprocessors.register(
+            AnchorlinksTreeprocessor(md, self.getConfig('ignore')),
+            'anchorlinks',
+            TREEPROCESSOR_PRIORITY
+        )
+
+
+def is_markdown_source(source_path):
+    return os.path.splitext(source_path)[1][1:] in MarkdownReader.file_extensions
+
+
+class AnchorlinksVisitor(pipeline.Visitor):
+    """
+    Adds the anchorlink class to links to anchors on the same page
+    """
+    name = "anchorlinks"
+    tags = ("a",)
+    setting_names = (IGNORE_VAR_NAME, MODE_VAR_NAME)
+
+    def begin(self, ctx):
+        ignore_tags = ctx.settings.get(IGNORE_VAR_NAME, DEFAULT_IGNORE)
+        mode = ctx.settings.get(MODE_VAR_NAME, DEFAULT_MODE)
+        if mode == MODE_SOUP:
+            return ignore_tags
+        if mode == MODE_MARKDOWN and is_markdown_source(ctx.source_path):
+            # Already done by the treeprocessor
+            return False
+
+        content = rewrite_content(ctx.content, ignore_tags)
+        if content is not None:
+            ctx.rewrite(content)
+        # No need for the tree
+        return False
+
+    def visit(self, ctx, ignore_tags, anchor):
+        if anchor.get('href', '').startswith("#"):
             tag_class = anchor.get('class', [])
             if not any(c in tag_class for c in ignore_tags):
-                anchor['class'] = tag_class + ['anchorlink']
-                dirty = True
-
-    if dirty:
-        article._content = str(soup_doc)
-
-    return
-
-
-def add_deps(generators):
-    # Process the articles and pages
-    for generator in generators:
-        if isinstance(generator, ArticlesGenerator):
-            for article in generator.articles:
-                process_content(article)
-            for article in generator.drafts:
-                process_content(article)
-            for article in generator.translations:
-                process_content(article)
-            for article in generator.drafts_translations:
-                process_content(article)
-        elif isinstance(generator, PagesGenerator):
-            for page in generator.pages:
-                process_content(page)
-            for page in generator.hidden_pages:
-                process_content(page)
-            for page in generator.draft_pages:
-                process_content(page)
-            for page in generator.translations:
-                process_content(page)
-            for page in generator.hidden_translations:
-                process_content(page)
-            for page in generator.draft_translations:
-                process_content(page)
+                anchor['class'] = tag_class + [ANCHORLINK_CLASS]
+                ctx.dirty = True
+
+
+def pelican_init(pelican_object):
+    settings = pelican_object.settings
+    if settings.get(MODE_VAR_NAME, DEFAULT_MODE) != MODE_MARKDOWN:
+        return
+    if Extension is object:
+        logging.warning(f"{MODE_VAR_NAME} is {MODE_MARKDOWN!r}, but markdown isn't installed")
+        return
+    settings['MARKDOWN'].setdefault('extensions', []).append(
+        AnchorlinksExtension(ignore=settings.get(IGNORE_VAR_NAME, DEFAULT_IGNORE))
+    )
 
 
 def register():
-    signals.all_generators_finalized.connect(add_deps)
+    gio_common.register()
+    signals.initialized.connect(pelican_init)
+    pipeline.register_visitor(AnchorlinksVisitor())
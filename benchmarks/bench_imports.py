@@ -0,0 +1,124 @@
+#!/bin/env -S py -3
+"""
+Plugin import-time benchmark.
+
+Imports and registers each plugin in a fresh process that has already
+imported Pelican, and reports how long that took and which new top-level
+modules it pulled in. Network and NLP libraries should only be imported once
+they're needed, so a plugin that imports one of DEFERRED just by being loaded
+is reported, and the exit status is 1.
+
+    py benchmarks/bench_imports.py --repeat 5
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PLUGINS = [
+    "anchorlinks",
+    "chrono",
+    "full_outline",
+    "gio_common",
+    "hash_drafts",
+    "htmlval",
+    "perma_social",
+    "prune_tags",
+    "redirects",
+    "related_reading",
+    "renderdeps",
+    "sex_vampires",
+    "twitter_gallery",
+    "wordcount",
+]
+
+# Modules no plugin should import just by being loaded
+DEFERRED = {"tweepy", "gallery_dl", "timeout_decorator", "chitose", "requests", "nltk", "numpy"}
+# ...and, on top of those, per plugin
+DEFERRED_BY_PLUGIN = {
+    "perma_social": {"bs4"},
+    "wordcount": {"bs4", "lxml"},
+}
+
+CHILD = """
+import json, sys, time
+sys.path[:0] = [{repo!r}]
+# Loaded by every build before any plugin
+import pelican, pelican.generators, pelican.readers
+before = set(sys.modules)
+start = time.perf_counter()
+import {plugin}
+{plugin}.register()
+seconds = time.perf_counter() - start
+modules = sorted({{name.split('.')[0] for name in set(sys.modules) - before}})
+print(json.dumps({{'seconds': seconds, 'modules': modules}}))
+"""
+
+
+def measure(plugin):
+    proc = subprocess.run(
+        [sys.executable, "-c", CHILD.format(repo=REPO, plugin=plugin)],
+        capture_output=True, text=True
+    )
+    if proc.returncode != 0:
+        return {'error': proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f"exit {proc.returncode}"}
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def bench(plugins, repeat=1):
+    results = []
+    for plugin in plugins:
+        runs = [measure(plugin) for _ in range(repeat)]
+        ok = [run for run in runs if 'error' not in run]
+        if not ok:
+            results.append({'plugin': plugin, **runs[0]})
+            continue
+        deferred = DEFERRED | DEFERRED_BY_PLUGIN.get(plugin, set())
+        results.append({
+            'plugin': plugin,
+            'seconds': min(run['seconds'] for run in ok),
+            'modules': ok[0]['modules'],
+            'eager': sorted(deferred.intersection(ok[0]['modules'])),
+        })
+    return results
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description=textwrap.dedent(__doc__),
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--plugins', nargs='*', default=PLUGINS, help="Plugins to benchmark")
+    parser.add_argument('--repeat', type=int, default=3, help="Imports per plugin; the fastest is kept")
+    parser.add_argument('--verbose', action='store_true', help="List every module each plugin imports")
+    parser.add_argument('--json', help="Also write the results to this file")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    results = bench(args.plugins, args.repeat)
+
+    failed = False
+    for row in results:
+        if 'error' in row:
+            print(f"{row['plugin']:<16} {row['error']}")
+            continue
+        print(f"{row['plugin']:<16} {row['seconds'] * 1000:8.1f} ms {len(row['modules']):4} modules")
+        if args.verbose:
+            print(textwrap.indent(textwrap.fill(" ".join(row['modules'])), " " * 4))
+        if row['eager']:
+            failed = True
+            print(f"    imported at load time: {', '.join(row['eager'])}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fp:
+            json.dump(results, fp, indent=1)
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,200 @@
+#!/bin/env -S py -3
+"""
+Plugin benchmarks over synthetic sites.
+
+For each corpus size, generates a site (see synthsite.py) and builds it once
+with no plugins, once with each plugin on its own, and once with all of them,
+each build in a fresh process. Reports wall time, the time over the
+no-plugin baseline, and peak RSS.
+
+    py benchmarks/bench_plugins.py --sizes 100 1000 --json results.json
+
+Plugins whose dependencies aren't installed are reported as skipped.
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+
+import synthsite
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PLUGINS = [
+    "anchorlinks",
+    "chrono",
+    "full_outline",
+    "hash_drafts",
+    "htmlval",
+    "perma_social",
+    "prune_tags",
+    "redirects",
+    "related_reading",
+    "renderdeps",
+    "sex_vampires",
+    "twitter_gallery",
+    "wordcount",
+]
+
+BASELINE = "(none)"
+ALL = "(all)"
+
+
+def site_settings(site, plugins, processes, derived_cache):
+    return {
+        'PATH': os.path.join(site, "content"),
+        'OUTPUT_PATH': os.path.join(site, "output"),
+        'CACHE_PATH': os.path.join(site, "cache"),
+        'PLUGIN_PATHS': [REPO],
+        'PLUGINS': ["gio_common", *plugins] if plugins else [],
+        'THEME_TEMPLATES_OVERRIDES': [os.path.join(site, "templates")],
+        'SITEURL': '',
+        'TIMEZONE': 'UTC',
+        'CACHE_CONTENT': False,
+        'LOAD_CONTENT_CACHE': False,
+        'FEED_ALL_ATOM': None,
+        'CATEGORY_FEED_ATOM': None,
+        'RENDER_DEPS': [
+            ((["pre"], {"class_": "mermaid"}), '<script src="mermaid.js"></script>'),
+            ((["pre"], {"class_": "markdeep"}), '<script src="markdeep.js"></script>'),
+        ],
+        'WORDCOUNT_WPM': 200,
+        'TAG_SAVE_AS_REVERSE': 'tag/{slug}/reverse.html',
+        'CATEGORY_SAVE_AS_REVERSE': 'category/{slug}/reverse.html',
+        'AUTHOR_SAVE_AS_REVERSE': 'author/{slug}/reverse.html',
+        'TWGALLERY_GLOB': os.path.join(site, "socialposts", "tweets", "*", "*.json"),
+        'GIO_PROCESSES': processes,
+        'GIO_DERIVED_CACHE': derived_cache,
+    }
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def child(site, plugins, processes, derived_cache):
+    """Build `site` once in this process and print the measurements as json"""
+    import logging
+
+    from pelican import Pelican
+    from pelican.settings import read_settings
+
+    logging.basicConfig(level=logging.ERROR)
+    # Social plugins read their offline fixtures relative to the working directory
+    os.chdir(site)
+
+    start = time.perf_counter()
+    settings = read_settings(override=site_settings(site, plugins, processes, derived_cache))
+    Pelican(settings).run()
+    seconds = time.perf_counter() - start
+
+    print(json.dumps({'seconds': seconds, 'peak_rss_mb': peak_rss_mb()}))
+
+
+def available(plugin):
+    """Whether a plugin's dependencies import here"""
+    proc = subprocess.run(
+        [sys.executable, "-c", f"import sys; sys.path[:0] = [{REPO!r}]; import {plugin}"],
+        capture_output=True
+    )
+    return proc.returncode == 0
+
+
+def measure(site, plugins, processes, derived_cache):
+    cmd = [
+        sys.executable, os.path.abspath(__file__), "--child", site,
+        "--processes", str(processes),
+        "--plugins", *plugins
+    ]
+    if derived_cache:
+        cmd.append("--derived-cache")
+    proc = subprocess.run(cmd, capture_output=True, text=True)
+    if proc.returncode != 0:
+        return {'error': proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f"exit {proc.returncode}"}
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def best_of(repeat, *args):
+    runs = [measure(*args) for _ in range(repeat)]
+    ok = [run for run in runs if 'error' not in run]
+    if not ok:
+        return runs[0]
+    return {
+        'seconds': min(run['seconds'] for run in ok),
+        'peak_rss_mb': max(run['peak_rss_mb'] for run in ok),
+    }
+
+
+def bench(sizes, plugins, repeat=1, processes=1, derived_cache=False, workdir=None):
+    results = []
+    skipped = [plugin for plugin in plugins if not available(plugin)]
+    runnable = [plugin for plugin in plugins if plugin not in skipped]
+    configs = [(BASELINE, []), *((plugin, [plugin]) for plugin in runnable), (ALL, runnable)]
+
+    for size in sizes:
+        with tempfile.TemporaryDirectory(dir=workdir) as site:
+            synthsite.generate(site, size)
+            baseline = None
+            for label, config in configs:
+                result = best_of(repeat, site, config, processes, derived_cache)
+                if label == BASELINE:
+                    baseline = result.get('seconds')
+                if 'seconds' in result and baseline is not None:
+                    result['over_baseline'] = result['seconds'] - baseline
+                results.append({'articles': size, 'plugins': label, **result})
+                print_row(results[-1])
+
+        for plugin in skipped:
+            results.append({'articles': size, 'plugins': plugin, 'error': "skipped, dependencies not installed"})
+            print_row(results[-1])
+
+    return results
+
+
+def print_row(row):
+    if 'error' in row:
+        print(f"{row['articles']:>7} {row['plugins']:<16} {row['error']}", flush=True)
+        return
+    over = row.get('over_baseline')
+    over = f"{over:+9.3f}s" if over is not None else ""
+    print(f"{row['articles']:>7} {row['plugins']:<16} {row['seconds']:9.3f}s {over:>10} {row['peak_rss_mb']:9.1f} MB", flush=True)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description=textwrap.dedent(__doc__),
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000], help="Corpus sizes, in articles")
+    parser.add_argument('--plugins', nargs='*', default=PLUGINS, help="Plugins to benchmark")
+    parser.add_argument('--repeat', type=int, default=1, help="Builds per configuration; the fastest is kept")
+    parser.add_argument('--processes', type=int, default=1, help="GIO_PROCESSES for each build")
+    parser.add_argument('--derived-cache', action='store_true', help="Leave GIO_DERIVED_CACHE on; with --repeat, builds after the first are warm")
+    parser.add_argument('--workdir', help="Where to generate the sites (default: system temp)")
+    parser.add_argument('--json', help="Also write the results to this file")
+    parser.add_argument('--child', metavar="SITE", help=argparse.SUPPRESS)
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    if args.child:
+        child(args.child, args.plugins, args.processes, args.derived_cache)
+        sys.exit(0)
+
+    print(f"{'articles':>7} {'plugins':<16} {'time':>10} {'over base':>10} {'peak rss':>12}")
+    results = bench(args.sizes, args.plugins, args.repeat, args.processes, args.derived_cache, args.workdir)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fp:
+            json.dump(results, fp, indent=1)
@@ -0,0 +1,70 @@
+#!/bin/env -S py -3
+"""
+Checks wordcount's batch readability against the scalar path.
+
+Scores random texts, built from the synthetic site's words plus the
+punctuation and whitespace edge cases the sentence counting cares about,
+once with text_stats/scoreStats and once with batchReadability, and reports
+every text where they differ. The exit status is 1 if any do.
+
+    py benchmarks/check_readability.py --texts 5000 --seed 2
+"""
+
+import argparse
+import os
+import random
+import sys
+
+import synthsite
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [REPO]
+
+import wordcount  # noqa: E402
+
+PIECES = [
+    " ", "  ", ". ", ".", "!", "?:", ";", "\n", "\t", "42", "don't", "é", "\xa0",
+    "...", " . ", "Hello", "recorded", "syllable", "x",
+]
+EDGE_CASES = ["", " ", ".", ". ", " .", "a", "a b", "a b.", " a b. c d. "]
+
+
+def make_texts(count, seed):
+    rnd = random.Random(seed)
+    pieces = PIECES + synthsite.WORDS
+    texts = [
+        "".join(rnd.choice(pieces) for _ in range(rnd.randint(0, 60)))
+        for _ in range(count)
+    ]
+    texts += EDGE_CASES
+    wcs = [rnd.choice([0, 0, 1, 7, 100]) for _ in texts]
+    return texts, wcs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--texts", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=2)
+    args = parser.parse_args()
+
+    if not wordcount.loadNumpy():
+        sys.exit("numpy isn't installed, so there's no batch path to check")
+
+    texts, wcs = make_texts(args.texts, args.seed)
+    scalar = [wordcount.scoreStats(wordcount.text_stats(text, wc)) for text, wc in zip(texts, wcs)]
+
+    mismatches = 0
+    # All at once, and one at a time so each text is also its own batch
+    batches = [(texts, wcs, scalar)] + [([t], [wc], [s]) for t, wc, s in zip(texts, wcs, scalar)]
+    for batch_texts, batch_wcs, expected in batches:
+        for text, wc, want, got in zip(batch_texts, batch_wcs, expected, wordcount.batchReadability(batch_texts, batch_wcs)):
+            if want != got:
+                mismatches += 1
+                print(f"{text!r} (wc {wc}): scalar {want}, batch {got}")
+
+    print(f"{mismatches} mismatches over {len(texts)} texts")
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
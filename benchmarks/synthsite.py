@@ -0,0 +1,165 @@
+#!/bin/env -S py -3
+"""
+Synthetic Pelican site generator for the plugin benchmarks.
+
+Writes N markdown articles that exercise every plugin: sections with ids,
+same-page and cross-page anchors, nested blockquotes, related-reading links,
+renderdeps triggers, redirect metadata, drafts, tags, and tweet embeds backed
+by offline fixtures under `socialposts/`.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import textwrap
+
+WORDS = (
+    "the of and to in is that it was for on are as with his they at be this from have or by "
+    "one had not but what all were when we there can an your which their said if do will each "
+    "about how up out them then she many some so these would other into has more her two like "
+    "him see time could no make than first been its who now people my made over did down only "
+    "way find use may water long little very after words called just where most know pelican "
+    "plugin article section anchor quote render search outline reading gallery vampire"
+).split()
+
+CATEGORIES = 8
+TAGS = 40
+USERS = 5
+
+TWEET_EVERY = 10
+DRAFT_EVERY = 20
+MERMAID_EVERY = 7
+
+TEMPLATES = {
+    "full_outline.html": "{% for category, nodes in full_outline %}{{ category }}{% for node in nodes %}{{ node.title }}{% endfor %}{% endfor %}",
+    "relatedreading.html": "{% for category, nodes in related_reading %}{{ category }}{% for node in nodes %}{{ node.links|length }}{% endfor %}{% endfor %}",
+    "twgallery_index.html": "{% for year, months in calendar.items() %}{{ year }}{% endfor %}",
+    "twgallery_month.html": "{{ month_name }} {{ year }}{{ content }}",
+}
+
+
+def sentence(rng, length=None):
+    length = length or rng.randint(6, 18)
+    words = [rng.choice(WORDS) for _ in range(length)]
+    words[0] = words[0].capitalize()
+    return " ".join(words) + rng.choice(".!?.")
+
+
+def paragraph(rng, sentences=None):
+    return " ".join(sentence(rng) for _ in range(sentences or rng.randint(2, 5)))
+
+
+def tweetId(i):
+    return 1000000000000000000 + i
+
+
+def tweetFixture(i, date):
+    user = f"synth{i % USERS}"
+    return user, {
+        "id": tweetId(i),
+        "id_str": str(tweetId(i)),
+        "created_at": date.strftime("%a %b %d %H:%M:%S +0000 %Y"),
+        "full_text": f"Synthetic tweet {i}",
+        "user": {
+            "screen_name": user,
+            "name": user.capitalize(),
+            "description": "A synthetic account",
+            "profile_image_url_https": f"https://pbs.twimg.com/profile_images/{i % USERS}/avatar.png",
+        },
+        "entities": {},
+        "extended_entities": {},
+    }
+
+
+def article(rng, i, count, date):
+    slug = f"article-{i}"
+    tags = sorted({f"tag{rng.randrange(TAGS)}" for _ in range(rng.randint(1, 4))})
+    lines = [
+        f"Title: Synthetic article {i}",
+        f"Date: {date:%Y-%m-%d %H:%M}",
+        f"Category: category{i % CATEGORIES}",
+        f"Tags: {', '.join(tags)}",
+        f"Slug: {slug}",
+        f"Summary: {sentence(rng)}",
+        f"Redirect: old/{slug}",
+    ]
+    if i % DRAFT_EVERY == DRAFT_EVERY - 1:
+        lines.append("Status: draft")
+    lines.append("")
+
+    lines += [paragraph(rng), ""]
+
+    sections = rng.randint(2, 6)
+    other = rng.randrange(count)
+    lines += [
+        f"Jump to [the first section](#s{i}-0), or read [another article](/article-{other}.html#s{other}-0).",
+        "",
+    ]
+
+    for j in range(sections):
+        lines += [
+            f'<section id="s{i}-{j}"><h2>Section {j} of article {i}</h2>',
+            f"<p>{paragraph(rng)} <a href=\"#s{i}-{rng.randrange(sections)}\">see also</a></p>",
+            f"<blockquote><p>{paragraph(rng, 2)}</p><blockquote><p>{sentence(rng)}</p></blockquote></blockquote>",
+            f"<p>{paragraph(rng)}</p>",
+            f'<div class="related-reading"><a href="https://example.com/{i}/{j}">Further reading {j}</a></div>',
+            "</section>",
+            "",
+        ]
+
+    if i % MERMAID_EVERY == 0:
+        lines += ['<pre class="mermaid">graph TD; A-->B;</pre>', ""]
+
+    if i % TWEET_EVERY == 0:
+        lines += [f"![](https://twitter.com/synth{i % USERS}/status/{tweetId(i)})", ""]
+
+    return slug, "\n".join(lines)
+
+
+def generate(path, count, seed=0):
+    """Write a synthetic site with `count` articles under `path`"""
+    rng = random.Random(seed)
+    start = datetime.datetime(2015, 1, 1)
+
+    content_dir = os.path.join(path, "content")
+    os.makedirs(content_dir, exist_ok=True)
+
+    for i in range(count):
+        date = start + datetime.timedelta(hours=7 * i)
+        slug, text = article(rng, i, count, date)
+        with open(os.path.join(content_dir, f"{slug}.md"), "w", encoding="utf-8") as fp:
+            fp.write(text)
+
+        if i % TWEET_EVERY == 0:
+            user, tweet = tweetFixture(i, date)
+            tweet_dir = os.path.join(path, "socialposts", "tweets", user)
+            os.makedirs(tweet_dir, exist_ok=True)
+            with open(os.path.join(tweet_dir, f"s{tweet['id']}.json"), "w", encoding="utf-8") as fp:
+                json.dump(tweet, fp, indent=2)
+
+    template_dir = os.path.join(path, "templates")
+    os.makedirs(template_dir, exist_ok=True)
+    for name, body in TEMPLATES.items():
+        with open(os.path.join(template_dir, name), "w", encoding="utf-8") as fp:
+            fp.write(body)
+
+    return path
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description=textwrap.dedent(__doc__),
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('path', help="Directory to write the site to")
+    parser.add_argument('--articles', type=int, default=100, help="Number of articles")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    generate(args.path, args.articles, args.seed)
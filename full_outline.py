@@ -2,17 +2,29 @@
 
 import re
 import itertools
-from bs4 import BeautifulSoup
+import os.path
+import sys
 
 import logging
 from pelican import signals
 from pelican.generators import CachingGenerator
 
+try:
+    import gio_common
+except ImportError:
+    # PLUGIN_PATHS isn't on sys.path, so find gio_common next to this plugin
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    import gio_common
+from gio_common import cache, doctree
+
 import collections
 
 
 logger = logging.getLogger(__name__)
 
+# Bump when the shape of cached outlines changes
+CACHE_VERSION = 1
+
 def unTypography(string):
     ret = string
     # Uncaught whitespace
@@ -51,6 +63,8 @@ class FullOutlineGenerator(CachingGenerator):
         self.json_nodes = []
         self.save_as = "full_outline.html"
 
+        self.outline_cache = cache.get_cache("full_outline", CACHE_VERSION, settings)
+
     def generate_output(self, writer):
         # Gather all the content we can
         pages = self.context['pages'] + self.context['articles']
@@ -94,10 +108,11 @@ class FullOutlineGenerator(CachingGenerator):
                 })
             return r
 
-        soup_text = BeautifulSoup(page.content, 'html.parser')
-
         node = {}
-        node['children'] = tocFromElement(soup_text, page.url)
+        node['children'] = self.outline_cache.fetch(
+            lambda: tocFromElement(doctree.get(page), page.url),
+            page._content, page.url
+        )
         node['page'] = page
         node['url'] = page.url
         node['title'] = page.title
@@ -108,4 +123,5 @@ def get_generators(generators):
     return FullOutlineGenerator
 
 def register():
+    gio_common.register()
     signals.get_generators.connect(get_generators)
@@ -0,0 +1,66 @@
+# -*- coding: utf8 -*-
+"""
+Shared services for the plugins in this repository.
+
+Pelican loads plugins from PLUGIN_PATHS without putting that directory on
+`sys.path`, so the plugins that use `gio_common` add their own directory when
+it can't be imported otherwise. It doesn't need to be in PLUGINS.
+
+Only the light services are imported here. `doctree` and `pipeline` (and
+with them bs4) are imported by the plugins that use them, so a plugin that
+only needs the cache doesn't pay for a parser.
+"""
+
+import sys
+
+from pelican import signals
+
+from . import cache, profiling
+
+
+def loaded(name):
+    """The gio_common submodule `name` if some plugin imported it, else None"""
+    return sys.modules.get(f"{__name__}.{name}")
+
+
+def configure_doctree(pelican_object):
+    """
+    Pelican callback
+    """
+    doctree = loaded("doctree")
+    if doctree is not None:
+        doctree.configure(pelican_object)
+
+
+def run_pipeline(generators):
+    """
+    Pelican callback
+    """
+    # No plugin imported the pipeline, so no visitors were registered
+    pipeline = loaded("pipeline")
+    if pipeline is not None:
+        pipeline.run(generators)
+
+
+def clear_doctree(*args):
+    """
+    Pelican callback
+    """
+    doctree = loaded("doctree")
+    if doctree is not None:
+        doctree.clear()
+
+
+def register():
+    """
+    Part of Pelican API
+
+    Plugins that use these services call this from their own `register`, so
+    listing `gio_common` itself doesn't do anything more.
+    Connecting the same receiver twice is a no-op.
+    """
+    signals.initialized.connect(configure_doctree)
+    signals.initialized.connect(profiling.configure)
+    signals.all_generators_finalized.connect(run_pipeline)
+    signals.finalized.connect(clear_doctree)
+    signals.finalized.connect(cache.save_all)
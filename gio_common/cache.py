@@ -0,0 +1,188 @@
+# -*- coding: utf8 -*-
+"""
+Persistent derived-data cache
+
+Plugins that compute something from an article's content (outlines, link
+lists, search text, readability stats...) can keep the result on disk here,
+so the next build only recomputes it for articles that changed.
+
+Each plugin gets its own namespace, stored as one pickle under CACHE_PATH.
+Entries are keyed by a hash of the content (plus any extra key parts the
+plugin passes), and the whole namespace is thrown out when the plugin's
+version or any of the settings it depends on change.
+"""
+
+import collections
+import gzip
+import hashlib
+import logging
+import os
+import pickle  # noqa: S403
+
+logger = logging.getLogger(__name__)
+
+# Documents, not entries: a plugin can store several entries per document
+DEFAULT_MAX_DOCUMENTS = 20000
+
+# Settings every namespace depends on: derived data is read from parsed trees
+COMMON_SETTING_NAMES = ('GIO_HTML_PARSER',)
+
+_caches = {}
+
+
+def content_hash(html):
+    """Stable digest of a content string, for keys that outlive the process"""
+    return hashlib.blake2b(html.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def fingerprint(version, settings, setting_names=()):
+    return (version, tuple(
+        (name, repr(settings.get(name)))
+        for name in sorted({*setting_names, *COMMON_SETTING_NAMES})
+    ))
+
+
+class DerivedDataCache:
+    def __init__(self, namespace, version, settings, setting_names=()):
+        self.namespace = namespace
+        self.enabled = settings.get('GIO_DERIVED_CACHE', True)
+        self.max_documents = settings.get('GIO_DERIVED_CACHE_SIZE', DEFAULT_MAX_DOCUMENTS)
+        self.gzip = settings.get('GZIP_CACHE', True)
+        self.path = os.path.join(
+            settings.get('CACHE_PATH', 'cache'), 'gio_derived', f"{namespace}.pickle"
+        )
+
+        self.fingerprint = fingerprint(version, settings, setting_names)
+
+        self._entries = None
+        self._dirty = False
+
+    def _open(self, mode):
+        return gzip.open(self.path, mode) if self.gzip else open(self.path, mode)
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            self._entries = collections.OrderedDict()
+            if self.enabled and os.path.isfile(self.path):
+                try:
+                    with self._open('rb') as fp:
+                        stored, entries = pickle.load(fp)  # noqa: S301
+                    if stored == self.fingerprint:
+                        self._entries = entries
+                    else:
+                        logger.info(f"Derived cache {self.namespace}: settings or version changed, starting over")
+                except Exception:
+                    logger.warning(f"Derived cache {self.namespace}: could not load {self.path}", exc_info=True)
+        return self._entries
+
+    def key(self, content, *extra):
+        return (content_hash(content), *extra)
+
+    def get(self, content, *extra, default=None):
+        if not self.enabled:
+            return default
+        key = self.key(content, *extra)
+        try:
+            value = self.entries[key]
+        except KeyError:
+            return default
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, content, value, *extra):
+        if not self.enabled:
+            return
+        key = self.key(content, *extra)
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        self._dirty = True
+
+    def fetch(self, compute, content, *extra):
+        """Return the cached value for `content`, computing and storing it on a miss"""
+        if not self.enabled:
+            return compute()
+        key = self.key(content, *extra)
+        try:
+            value = self.entries[key]
+            self.entries.move_to_end(key)
+        except KeyError:
+            value = compute()
+            self.entries[key] = value
+            self._dirty = True
+        return value
+
+    def get_state(self, name, default=None):
+        """
+        Return a value stored under `name` rather than under some content,
+        for plugins that carry a summary of the whole site between builds
+        """
+        return self.get('', 'state', name, default=default)
+
+    def set_state(self, name, value):
+        self.set('', value, 'state', name)
+
+    def evict(self, entries):
+        """
+        Keep the entries of the `max_documents` most recently used contents,
+        dropping every entry of the rest together
+        """
+        recent = set()
+        for key in reversed(entries):
+            if key[0] not in recent:
+                if len(recent) == self.max_documents:
+                    break
+                recent.add(key[0])
+        else:
+            return
+        for key in [key for key in entries if key[0] not in recent]:
+            del entries[key]
+
+    def release(self):
+        """
+        Save, then drop the entries from memory. They're loaded again the next
+        time they're used, e.g. by the next build under --autoreload.
+        """
+        self.save()
+        self._entries = None
+        self._dirty = False
+
+    def save(self):
+        if not (self.enabled and self._dirty):
+            return
+
+        entries = self.entries
+        if self.max_documents:
+            self.evict(entries)
+
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with self._open('wb') as fp:
+                pickle.dump((self.fingerprint, entries), fp)
+            self._dirty = False
+        except Exception:
+            logger.warning(f"Derived cache {self.namespace}: could not save {self.path}", exc_info=True)
+
+
+def get_cache(namespace, version, settings, setting_names=()):
+    """
+    Return the cache for a namespace, creating it on first use.
+
+    If the version or relevant settings differ from the cache already open
+    under that name (e.g. settings changed under --autoreload), it's saved and
+    replaced.
+    """
+    cache = _caches.get(namespace)
+    if cache is None or cache.fingerprint != fingerprint(version, settings, setting_names):
+        if cache is not None:
+            cache.save()
+        cache = _caches[namespace] = DerivedDataCache(namespace, version, settings, setting_names)
+    return cache
+
+
+def save_all(*args):
+    """
+    Pelican callback
+    """
+    for cache in _caches.values():
+        cache.save()
@@ -0,0 +1,85 @@
+# -*- coding: utf8 -*-
+"""
+Declared render dependencies
+
+Producers that know what a document needs while rendering it (customblock
+callbacks, readers, markdown extensions) record the names of those
+dependencies in the document's `render_deps` metadata. Renderdeps includes
+the RENDER_DEPS entries with those names directly, instead of searching the
+rendered html for them.
+
+Producers that don't otherwise need gio_common shouldn't import it just for
+this. They send the SIGNAL_NAME blinker signal instead, which only renderdeps
+connects `receive` to, so nothing is declared unless renderdeps is running:
+
+    blinker.signal("gio_common.render_deps").send(md, names=["discord"])
+
+Authors can declare dependencies by hand too, with `Render_deps: a, b`.
+"""
+
+import blinker
+
+METADATA_KEY = "render_deps"
+
+SIGNAL_NAME = "gio_common.render_deps"
+signal = blinker.signal(SIGNAL_NAME)
+
+
+def declare(target, *names):
+    """
+    Record that the document being rendered needs `names`. `target` is the
+    Markdown instance doing the rendering, whose Meta becomes the document's
+    metadata, or a reader's metadata dict.
+    """
+    if isinstance(target, dict):
+        metadata = target
+    else:
+        if not hasattr(target, 'Meta'):
+            target.Meta = {}
+        metadata = target.Meta
+
+    values = metadata.get(METADATA_KEY)
+    if values is None:
+        values = metadata[METADATA_KEY] = []
+    elif isinstance(values, str):
+        values = metadata[METADATA_KEY] = [values]
+    for name in names:
+        if name not in values:
+            values.append(name)
+
+
+def declared(metadata):
+    """The dependency names declared in `metadata`, in order, or [] for none"""
+    values = (metadata or {}).get(METADATA_KEY) or []
+    if isinstance(values, str):
+        values = [values]
+    names = []
+    for value in values:
+        for name in value.split(","):
+            name = name.strip()
+            if name and name not in names:
+                names.append(name)
+    return names
+
+
+def entry_name(entry):
+    """The name of a RENDER_DEPS entry, which is its optional third element"""
+    return entry[2] if len(entry) > 2 else None
+
+
+def provided(settings, name):
+    """Whether RENDER_DEPS has an entry for `name`"""
+    return any(entry_name(entry) == name for entry in settings.get("RENDER_DEPS", []))
+
+
+def receive(target, names=(), settings=None):
+    """
+    Receiver for `signal`, connected by renderdeps: `declare` the `names`
+    for `target`. Given the `settings`, only those RENDER_DEPS has an entry
+    for are declared. Returns the names declared.
+    """
+    if settings is not None:
+        names = [name for name in names if provided(settings, name)]
+    if names:
+        declare(target, *names)
+    return list(names)
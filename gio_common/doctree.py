@@ -0,0 +1,173 @@
+# -*- coding: utf8 -*-
+"""
+Shared parsed-document cache
+
+Several plugins need a BeautifulSoup tree of the same `_content`. Instead of
+each of them parsing it again, they ask this module, which parses a given
+string once and hands the same tree to everyone after that.
+
+Trees are keyed on the content string itself, so any change to `_content`
+misses the cache. Plugins that modify a tree must hand it back through
+`commit`, and plugins that rewrite `_content` as a string should go through
+`set_content`, so the stale tree is dropped right away.
+
+Trees returned by `parse` and `get` are shared: treat them as read-only.
+
+GIO_HTML_PARSER picks the parser for trees that are only read: any bs4
+builder ('html.parser', 'lxml', 'html5lib'), or 'lxml.html' to have `text`
+skip bs4 altogether. Trees that get serialized back into `_content` are
+always parsed with html.parser (ROUND_TRIP_PARSER), since other parsers
+normalize the markup and would change the output.
+"""
+
+import collections
+import logging
+
+import bs4
+import bs4.builder
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+from . import profiling
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_SIZE = 512
+
+ROUND_TRIP_PARSER = 'html.parser'
+DEFAULT_PARSER = ROUND_TRIP_PARSER
+# Not a bs4 builder: read text with lxml directly, and use bs4's lxml builder for trees
+RAW_LXML = 'lxml.html'
+
+# Elements whose strings aren't text, as far as bs4's get_text is concerned
+NON_TEXT_TAGS = {'script', 'style', 'template'}
+
+_trees = collections.OrderedDict()
+_cache_size = DEFAULT_CACHE_SIZE
+_parser = DEFAULT_PARSER
+
+stats = collections.Counter()
+
+
+def configure(pelican_object):
+    """
+    Pelican callback
+    """
+    global _cache_size, _parser
+    settings = pelican_object.settings
+    _cache_size = settings.get('GIO_DOCTREE_CACHE_SIZE', DEFAULT_CACHE_SIZE)
+
+    _parser = settings.get('GIO_HTML_PARSER', DEFAULT_PARSER)
+    available = lxml is not None if _parser == RAW_LXML else bs4.builder.builder_registry.lookup(_parser)
+    if not available:
+        logger.warning(f"Doctree: HTML parser {_parser!r} is not available, using {DEFAULT_PARSER!r}")
+        _parser = DEFAULT_PARSER
+
+
+def features(mutable=False):
+    """The bs4 parser for a tree that will (or won't) be serialized back"""
+    if mutable:
+        return ROUND_TRIP_PARSER
+    return 'lxml' if _parser == RAW_LXML else _parser
+
+
+def soup(html, mutable=False):
+    """Parse an html string into a new, unshared tree"""
+    return bs4.BeautifulSoup(html, features(mutable))
+
+
+def _store(key, tree):
+    _trees[key] = tree
+    _trees.move_to_end(key)
+    if _cache_size:
+        while len(_trees) > _cache_size:
+            _trees.popitem(last=False)
+
+
+def parse(html, mutable=False):
+    """
+    Return the shared tree for an html string, parsing it on first use.
+
+    Pass mutable=True for a tree that may be modified and committed.
+    """
+    key = (features(mutable), html)
+    tree = _trees.get(key)
+    if tree is None:
+        stats['miss'] += 1
+        tree = bs4.BeautifulSoup(html, key[0])
+        _store(key, tree)
+    else:
+        stats['hit'] += 1
+        _trees.move_to_end(key)
+    return tree
+
+
+def get(instance):
+    """Return the shared read-only tree for a content object's `_content`"""
+    with profiling.phase('parse'):
+        return parse(instance._content)
+
+
+def text(html):
+    """
+    The visible text of an html string, as `get_text(' ', strip=True)`.
+
+    With GIO_HTML_PARSER = 'lxml.html' no bs4 tree is built.
+    """
+    if _parser != RAW_LXML:
+        return parse(html).get_text(' ', strip=True)
+    if not html.strip():
+        return ''
+    root = lxml.html.fragment_fromstring(html, create_parent='div')
+    return ' '.join(s for s in map(str.strip, _lxml_strings(root)) if s)
+
+
+def _lxml_strings(element):
+    # Comments and processing instructions have a non-str tag
+    if not isinstance(element.tag, str) or element.tag in NON_TEXT_TAGS:
+        return
+    if element.text:
+        yield element.text
+    for child in element:
+        yield from _lxml_strings(child)
+        if child.tail:
+            yield child.tail
+
+
+def discard(html):
+    """Drop the trees for an html string, if any"""
+    for mutable in (False, True):
+        _trees.pop((features(mutable), html), None)
+
+
+def set_content(instance, html):
+    """Replace `instance._content`, dropping the tree for the old content"""
+    discard(instance._content)
+    instance._content = html
+
+
+def commit(instance, tree):
+    """
+    Write a modified tree back to `instance._content`.
+
+    The tree for the old content is dropped, and the modified tree is kept as
+    the tree for the new content, so later plugins don't parse it again.
+    """
+    with profiling.phase('serialize'):
+        html = str(tree)
+    set_content(instance, html)
+    _store((ROUND_TRIP_PARSER, html), tree)
+    return html
+
+
+def clear(*args):
+    """
+    Pelican callback
+    """
+    if stats:
+        logger.debug(f"Doctree: {stats['hit']} hits, {stats['miss']} parses")
+    _trees.clear()
+    stats.clear()
@@ -0,0 +1,51 @@
+# -*- coding: utf8 -*-
+"""
+Process pool for per-document work
+
+Parsing and walking documents is CPU-bound, so threads don't help. This
+spreads jobs over a pool of worker processes instead. Jobs and their results
+are pickled, so they should be small and plain: a source path, the content
+and the few settings the work needs, not content objects or generators.
+
+Workers are forked, so they see every plugin module and pipeline visitor the
+parent loaded. Where fork isn't available, jobs run in the parent.
+"""
+
+import logging
+import multiprocessing
+import os
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROCESSES = 1
+
+
+def processes(settings):
+    """Number of worker processes to use. 0 or None means one per core."""
+    count = settings.get('GIO_PROCESSES', DEFAULT_PROCESSES)
+    if not count:
+        count = os.cpu_count() or 1
+    return count
+
+
+def map_jobs(worker, jobs, count):
+    """
+    Run `worker` over `jobs` with `count` processes, yielding results in
+    order. `worker` must be a module-level function.
+    """
+    if count <= 1 or len(jobs) < 2:
+        yield from map(worker, jobs)
+        return
+
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        logger.warning("Executor: fork is not available here, running in one process")
+        yield from map(worker, jobs)
+        return
+
+    count = min(count, len(jobs))
+    # A few chunks per worker evens out documents of different sizes
+    chunksize = max(1, len(jobs) // (count * 4))
+
+    logger.debug(f"Executor: {len(jobs)} jobs over {count} processes")
+    with multiprocessing.get_context('fork').Pool(count) as pool:
+        yield from pool.imap(worker, jobs, chunksize)
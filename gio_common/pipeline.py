@@ -0,0 +1,356 @@
+# -*- coding: utf8 -*-
+"""
+Single-pass HTML post-processing
+
+Plugins that used to walk every document's tree on their own register a
+`Visitor` here instead. Once all generators are finalized, each document is
+parsed once (through `doctree`), walked once, and each element is handed to
+the visitors that asked for it. The document is written back to a string at
+most once, after every visitor is done with it.
+
+A visitor's work on a document happens in `begin`, `visit` and `end`, which
+only see the `DocumentContext`. A visitor that edits the html as a string
+can do so in `begin` with `ctx.rewrite`, before the document is parsed. Whatever `end` returns is handed to `apply`
+along with the content object, which is where a visitor should touch the
+content object itself. A visitor that's finished with a document by the end
+of `begin`, without the tree, can return `Done(result)` to skip straight to
+`apply`.
+
+With GIO_PROCESSES > 1, documents are spread over worker processes (see
+`executor`). Workers only get the source path, the content, the settings
+named in the visitors' `setting_names` and the metadata named in their
+`metadata_names`, and `end` results must pickle.
+"""
+
+import collections
+import logging
+import time
+
+import bs4
+from pelican.generators import ArticlesGenerator, PagesGenerator, TemplatePagesGenerator
+
+from . import doctree, executor, profiling
+
+logger = logging.getLogger(__name__)
+
+TYPES_TO_PROCESS = [
+    "articles", "pages", "drafts", "draft_pages",
+    "hidden_pages", "hidden_articles",
+    "translations", "hidden_translations", "draft_translations", "drafts_translations"
+]
+
+DOCUMENT_GENERATORS = (ArticlesGenerator, PagesGenerator, TemplatePagesGenerator)
+
+visitors = []
+
+# Returned by Visitor.cached when there's no stored result
+MISS = object()
+
+
+# Returned by Visitor.begin to finish a document without the tree
+Done = collections.namedtuple("Done", ("result",))
+
+
+class Visitor:
+    """
+    Base class for pipeline visitors.
+
+    `tags` is the collection of tag names this visitor wants to see, or None
+    for every tag. `setting_names` are the settings it reads from
+    `ctx.settings`, and `metadata_names` the document metadata it reads from
+    `ctx.metadata`. A `read_only` visitor never modifies the tree, so when
+    only read-only visitors are active the document may be parsed with the
+    faster GIO_HTML_PARSER.
+    """
+    name = None
+    tags = None
+    setting_names = ()
+    metadata_names = ()
+    read_only = False
+
+    def cached(self, ctx):
+        """
+        Return a stored result for this document, or MISS. A document with a
+        stored result isn't visited; the result goes straight to `apply`.
+        """
+        return MISS
+
+    def store(self, ctx, result):
+        """Keep a freshly computed result for next time"""
+        pass
+
+    def begin(self, ctx):
+        """
+        Set up for a document and return the per-document state passed to
+        `visit` and `end`. Return False to sit this document out, or
+        `Done(result)` to hand `result` to `apply` without visiting.
+        """
+        return None
+
+    def visit(self, ctx, state, tag):
+        pass
+
+    def end(self, ctx, state):
+        """Finish a document. The return value is handed to `apply`."""
+        return None
+
+    def apply(self, instance, generator, result):
+        """Apply a document's result to its content object"""
+        pass
+
+    def finish(self):
+        """Called once every document has been processed"""
+        pass
+
+
+class DocumentContext:
+    def __init__(self, source_path, content, settings, metadata=None):
+        self.source_path = source_path
+        self.content = content
+        # What the document looked like before any visitor ran; cache key
+        self.original_content = content
+        self.settings = settings
+        self.metadata = metadata or {}
+
+        self.soup = None
+        # Set when a visitor modified the tree and it needs serializing
+        self.dirty = False
+        # Set when a visitor replaced the content string in `begin`
+        self.rewritten = False
+        # Raw html to append to the document after serializing
+        self.appendix = []
+        # New content produced by a worker process
+        self.replacement = None
+        # (level, message) pairs, logged by the parent process
+        self.diagnostics = []
+        # ('phase', name) and ('begin' / 'visit' / 'end', visitor name)
+        # timings, when profiling
+        self.timings = collections.Counter()
+
+    def append(self, html):
+        self.appendix.append(html)
+
+    def rewrite(self, html):
+        """Replace the content string. Only valid in `begin`, before parsing."""
+        self.content = html
+        self.rewritten = True
+
+    def log(self, level, message):
+        self.diagnostics.append((level, message))
+
+    def output(self):
+        """The new content, or None if nothing changed"""
+        if self.replacement is not None:
+            return self.replacement
+        if not self.dirty and not self.appendix and not self.rewritten:
+            return None
+        start = time.perf_counter()
+        content = str(self.soup) if self.dirty else self.content
+        content += "".join(self.appendix)
+        if profiling.ENABLED:
+            self.timings[('phase', 'serialize')] += time.perf_counter() - start
+        return content
+
+
+def register_visitor(visitor):
+    if any(v.name == visitor.name for v in visitors):
+        return
+    visitors.append(visitor)
+
+
+def _dispatch_table(active):
+    wildcard = [v for v in active if v.tags is None]
+    table = {}
+    for visitor in active:
+        for name in (visitor.tags or ()):
+            table.setdefault(name, []).append(visitor)
+    # Keep registration order within each tag
+    return {
+        name: sorted(vs + wildcard, key=active.index)
+        for name, vs in table.items()
+    }, wildcard
+
+
+def process_document(ctx, parse=doctree.parse, skip=()):
+    """
+    Run every visitor (except those named in `skip`) over one document.
+
+    Returns a {visitor name: result} dict.
+    """
+    timings = ctx.timings if profiling.ENABLED else None
+    perf_counter = time.perf_counter
+
+    states = {}
+    done = {}
+    for visitor in visitors:
+        if visitor.name in skip:
+            continue
+        start = perf_counter()
+        state = visitor.begin(ctx)
+        if timings is not None:
+            timings[('begin', visitor.name)] += perf_counter() - start
+        if isinstance(state, Done):
+            done[visitor.name] = state.result
+        elif state is not False:
+            states[visitor.name] = state
+
+    active = [v for v in visitors if v.name in states]
+
+    if active:
+        start = perf_counter()
+        ctx.soup = parse(ctx.content, mutable=not all(v.read_only for v in active))
+        table, wildcard = _dispatch_table(active)
+
+        if timings is not None:
+            timings[('phase', 'parse')] += perf_counter() - start
+            start = perf_counter()
+            _walk_timed(ctx, table, wildcard, states)
+            timings[('phase', 'traverse')] += perf_counter() - start
+        else:
+            _walk(ctx, table, wildcard, states)
+
+    results = done
+    for visitor in active:
+        start = perf_counter()
+        results[visitor.name] = visitor.end(ctx, states[visitor.name])
+        if timings is not None:
+            timings[('end', visitor.name)] += perf_counter() - start
+    return results
+
+
+def _walk(ctx, table, wildcard, states):
+    for element in ctx.soup.descendants:
+        if not isinstance(element, bs4.Tag):
+            continue
+        for visitor in table.get(element.name, wildcard):
+            visitor.visit(ctx, states[visitor.name], element)
+
+
+def _walk_timed(ctx, table, wildcard, states):
+    timings = ctx.timings
+    perf_counter = time.perf_counter
+    for element in ctx.soup.descendants:
+        if not isinstance(element, bs4.Tag):
+            continue
+        for visitor in table.get(element.name, wildcard):
+            start = perf_counter()
+            visitor.visit(ctx, states[visitor.name], element)
+            timings[('visit', visitor.name)] += perf_counter() - start
+
+
+def iter_documents(generators):
+    seen = set()
+    for generator in generators:
+        if not isinstance(generator, DOCUMENT_GENERATORS):
+            logger.debug(f"Pipeline: Unhandled generator {generator}")
+            continue
+        for attr in TYPES_TO_PROCESS:
+            for document in getattr(generator, attr, None) or []:
+                if id(document) not in seen:
+                    seen.add(id(document))
+                    yield document, generator
+
+
+def cached_results(ctx):
+    results = {}
+    for visitor in visitors:
+        result = visitor.cached(ctx)
+        if result is not MISS:
+            results[visitor.name] = result
+    return results
+
+
+def apply_results(instance, generator, ctx, results, cached=None):
+    cached = cached or {}
+    for visitor in visitors:
+        if visitor.name in results:
+            visitor.store(ctx, results[visitor.name])
+    results = {**results, **cached}
+
+    for level, message in ctx.diagnostics:
+        logger.log(level, message)
+
+    if profiling.ENABLED:
+        profiling.record_timings(__name__, ctx.source_path, ctx.timings)
+
+    if ctx.dirty and not ctx.appendix and ctx.soup is not None:
+        # Keep the tree, it's still good for the new content
+        doctree.commit(instance, ctx.soup)
+    else:
+        content = ctx.output()
+        if content is not None:
+            doctree.set_content(instance, content)
+
+    for visitor in visitors:
+        if visitor.name in results:
+            visitor.apply(instance, generator, results[visitor.name])
+
+
+def _parse_uncached(html, mutable=False):
+    # Workers have no use for the cache, nothing else runs there
+    return doctree.soup(html, mutable)
+
+
+def process_job(job):
+    """Worker side of `run`: process one document, return what changed"""
+    source_path, content, settings, metadata, skip = job
+    ctx = DocumentContext(source_path, content, settings, metadata)
+    results = process_document(ctx, parse=_parse_uncached, skip=skip)
+    return ctx.output(), results, ctx.diagnostics, ctx.timings
+
+
+def worker_settings(settings):
+    names = {name for visitor in visitors for name in visitor.setting_names}
+    return {name: settings[name] for name in names if name in settings}
+
+
+def document_metadata(document):
+    names = {name for visitor in visitors for name in visitor.metadata_names}
+    return {name: document.metadata[name] for name in names if name in document.metadata}
+
+
+def document_context(document):
+    return DocumentContext(document.relative_source_path, document._content, document.settings, document_metadata(document))
+
+
+def run(generators):
+    """
+    Pelican callback
+    """
+    if not visitors:
+        return
+
+    documents = []
+    for document, generator in iter_documents(generators):
+        if document._content is None:
+            logger.warning(f"{document.title} is empty!")
+            continue
+        documents.append((document, generator))
+
+    count = executor.processes(documents[0][0].settings) if documents else 1
+
+    if count > 1:
+        contexts = []
+        for document, generator in documents:
+            ctx = document_context(document)
+            contexts.append((document, generator, ctx, cached_results(ctx)))
+        jobs = [
+            (ctx.source_path, ctx.content, worker_settings(ctx.settings), ctx.metadata, tuple(cached))
+            for document, generator, ctx, cached in contexts
+        ]
+        outputs = executor.map_jobs(process_job, jobs, count)
+        for (document, generator, ctx, cached), (content, results, diagnostics, timings) in zip(contexts, outputs):
+            ctx.replacement = content
+            ctx.diagnostics = diagnostics
+            ctx.timings = timings
+            apply_results(document, generator, ctx, results, cached)
+    else:
+        # One context at a time, so each tree can be freed once it's applied
+        for document, generator in documents:
+            ctx = document_context(document)
+            cached = cached_results(ctx)
+            results = process_document(ctx, skip=cached)
+            apply_results(document, generator, ctx, results, cached)
+
+    for visitor in visitors:
+        visitor.finish()
@@ -0,0 +1,269 @@
+# -*- coding: utf8 -*-
+"""
+Opt-in build profiling
+
+With GIO_PROFILE = True, every signal handler registered by a module in this
+repository is wrapped to record its wall time and call count, along with the
+slowest documents per plugin and named sub-phases (parse, traverse,
+serialize, fetch...). At the end of the build a JSON and an HTML report are
+written to GIO_PROFILE_REPORT (+ .json, .html).
+
+With profiling off nothing is wrapped, and `phase` is a no-op.
+"""
+
+import collections
+import contextlib
+import functools
+import heapq
+import html
+import json
+import logging
+import os
+import sys
+import time
+import weakref
+
+import blinker
+from pelican import signals
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REPORT = "gio_profile"
+DEFAULT_TOP = 10
+
+# Modules in here are the ones we instrument
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Generator methods worth timing on their own
+GENERATOR_METHODS = ("generate_context", "generate_output", "nodeFromPage")
+
+ENABLED = False
+top_n = DEFAULT_TOP
+report_path = DEFAULT_REPORT
+
+handlers = collections.defaultdict(lambda: [0, 0.0])
+phases = collections.defaultdict(lambda: [0, 0.0])
+documents = collections.defaultdict(list)
+_stack = []
+_wrappers = {}
+_started = None
+
+
+def current_plugin():
+    return _stack[-1] if _stack else "unknown"
+
+
+def record_phase(plugin, name, seconds):
+    entry = phases[(plugin, name)]
+    entry[0] += 1
+    entry[1] += seconds
+
+
+def record_timings(plugin, source_path, timings):
+    """
+    Record timings collected away from the handler stack (e.g. in a worker
+    process): phases under `plugin`, and for every other key a phase under
+    its name, plus one document entry per name with its keys summed
+    """
+    totals = collections.Counter()
+    for (kind, name), seconds in timings.items():
+        if kind == 'phase':
+            record_phase(plugin, name, seconds)
+        else:
+            record_phase(name, kind, seconds)
+            totals[name] += seconds
+    for name, seconds in totals.items():
+        record_document(name, source_path, seconds)
+
+
+def record_document(plugin, source_path, seconds):
+    # Min-heap of the slowest top_n documents
+    heap = documents[plugin]
+    item = (seconds, source_path)
+    if len(heap) < top_n:
+        heapq.heappush(heap, item)
+    elif item > heap[0]:
+        heapq.heapreplace(heap, item)
+
+
+@contextlib.contextmanager
+def phase(name, plugin=None):
+    """Time a sub-phase, by default under whichever handler is running"""
+    if not ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(plugin or current_plugin(), name, time.perf_counter() - start)
+
+
+def timed(fn, plugin, name):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        _stack.append(plugin)
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            _stack.pop()
+            entry = handlers[(plugin, name)]
+            entry[0] += 1
+            entry[1] += elapsed
+            # Per-document handlers get passed the content object
+            for arg in args:
+                source_path = getattr(arg, 'relative_source_path', None)
+                if source_path:
+                    record_document(plugin, source_path, elapsed)
+                    break
+
+    wrapper.gio_profiled = True
+    return wrapper
+
+
+def timed_generator(cls):
+    """Subclass a generator class with its main methods timed"""
+    plugin = cls.__module__
+    methods = {
+        name: timed(getattr(cls, name), plugin, f"{cls.__name__}.{name}")
+        for name in GENERATOR_METHODS
+        if hasattr(cls, name)
+    }
+    return type(cls.__name__, (cls,), methods)
+
+
+def timed_get_generators(fn, plugin, name):
+    wrapped = timed(fn, plugin, name)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        classes = wrapped(*args, **kwargs)
+        if isinstance(classes, type):
+            return timed_generator(classes)
+        if classes is not None:
+            return [timed_generator(c) if isinstance(c, type) else c for c in classes]
+        return classes
+
+    wrapper.gio_profiled = True
+    return wrapper
+
+
+def is_ours(fn):
+    module = sys.modules.get(getattr(fn, '__module__', None) or '')
+    path = getattr(module, '__file__', None) or ''
+    return os.path.abspath(path).startswith(PLUGIN_DIR + os.sep)
+
+
+def instrument():
+    for signal in vars(signals).values():
+        if not isinstance(signal, blinker.Signal) or signal is signals.initialized:
+            continue
+
+        # Swap the wrapper in under the receiver's own id rather than
+        # reconnecting it, so receivers keep their place in the signal's
+        # (ordered) receiver list and the senders they were connected for
+        for receiver_id, receiver in list(signal.receivers.items()):
+            if isinstance(receiver, weakref.ref):
+                receiver = receiver()
+            if receiver is None or getattr(receiver, 'gio_profiled', False) or not is_ours(receiver):
+                continue
+            if receiver.__module__ == __name__:
+                continue
+
+            key = (signal.name, receiver)
+            wrapper = _wrappers.get(key)
+            if wrapper is None:
+                plugin = receiver.__module__
+                name = f"{signal.name}:{receiver.__name__}"
+                wrap = timed_get_generators if signal is signals.get_generators else timed
+                wrapper = _wrappers[key] = wrap(receiver, plugin, name)
+
+            # The wrapper holds the receiver, so its weakref stays alive too
+            signal.receivers[receiver_id] = wrapper
+
+    signals.finalized.connect(write_report)
+
+
+def configure(pelican_object):
+    """
+    Pelican callback
+    """
+    global ENABLED, top_n, report_path, _started
+    settings = pelican_object.settings
+    if not settings.get('GIO_PROFILE', False):
+        return
+
+    ENABLED = True
+    handlers.clear()
+    phases.clear()
+    documents.clear()
+    top_n = settings.get('GIO_PROFILE_TOP', DEFAULT_TOP)
+    report_path = settings.get('GIO_PROFILE_REPORT', DEFAULT_REPORT)
+    _started = time.perf_counter()
+    instrument()
+
+
+def report():
+    def rows(table):
+        return sorted(
+            (
+                {'plugin': plugin, 'name': name, 'calls': calls, 'seconds': round(seconds, 6)}
+                for (plugin, name), (calls, seconds) in table.items()
+            ),
+            key=lambda r: r['seconds'], reverse=True
+        )
+
+    return {
+        'total_seconds': round(time.perf_counter() - _started, 6) if _started else None,
+        'handlers': rows(handlers),
+        'phases': rows(phases),
+        'slowest_documents': {
+            plugin: [
+                {'source_path': source_path, 'seconds': round(seconds, 6)}
+                for seconds, source_path in sorted(heap, reverse=True)
+            ]
+            for plugin, heap in sorted(documents.items())
+        },
+    }
+
+
+def render_html(data):
+    def table(title, columns, rows):
+        head = "".join(f"<th>{html.escape(c)}</th>" for c in columns)
+        body = "".join(
+            "<tr>" + "".join(f"<td>{html.escape(str(row[c]))}</td>" for c in columns) + "</tr>"
+            for row in rows
+        )
+        return f"<h2>{html.escape(title)}</h2><table><tr>{head}</tr>{body}</table>"
+
+    parts = [
+        "<!DOCTYPE html><html><head><meta charset='utf-8'><title>Build profile</title>",
+        "<style>td,th{padding:0 1em;text-align:left}td:last-child{text-align:right}</style></head><body>",
+        f"<h1>Build profile</h1><p>Total: {data['total_seconds']}s</p>",
+        table("Handlers", ['plugin', 'name', 'calls', 'seconds'], data['handlers']),
+        table("Phases", ['plugin', 'name', 'calls', 'seconds'], data['phases']),
+    ]
+    for plugin, rows in data['slowest_documents'].items():
+        parts.append(table(f"Slowest documents: {plugin}", ['source_path', 'seconds'], rows))
+    parts.append("</body></html>")
+    return "".join(parts)
+
+
+def write_report(*args):
+    """
+    Pelican callback
+    """
+    if not ENABLED:
+        return
+
+    data = report()
+    directory = os.path.dirname(report_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(report_path + ".json", "w", encoding="utf-8") as fp:
+        json.dump(data, fp, indent=1)
+    with open(report_path + ".html", "w", encoding="utf-8") as fp:
+        fp.write(render_html(data))
+    logger.info(f"Profile written to {report_path}.json and {report_path}.html")
@@ -7,6 +7,8 @@ import xml.etree
 import xml.etree.ElementTree  # noqa: S405
 import logging
 
+import blinker
+
 
 Fragment: TypeAlias = xml.etree.ElementTree.Element
 Callback: TypeAlias = Callable[..., Fragment]
@@ -23,6 +25,15 @@ def customblock(name: str) -> Callable:
     return _customblock
 
 
+# Only renderdeps listens to this, see gio_common.deps
+render_deps = blinker.signal("gio_common.render_deps")
+
+
+def declare_dependency(ctx, name: str) -> None:
+    """Tell renderdeps this document needs `name`, if it's running"""
+    render_deps.send(ctx.parser.md, names=[name])
+
+
 def filter_key_prefixes(prefix_blacklist: Sequence[str], obj: dict) -> dict:
     """
     >>> filter_key_prefixes(['a_'], {'a_b': 1, 'b_c': 2})
@@ -78,6 +89,7 @@ def cb_blockquote(ctx, *args, **kwargs) -> Fragment:
 
 @customblock('spoiler')
 def cb_spoiler(ctx, desc=None, *args, **kwargs) -> Fragment:
+    declare_dependency(ctx, 'spoiler')
     slugargs = ['-'.join(arg.split()) for arg in args]
     return cbE(
         "div.spoiler-wrapper", {'_class': ' '.join(slugargs)},
@@ -96,6 +108,7 @@ def cb_spoiler(ctx, desc=None, *args, **kwargs) -> Fragment:
 
 @customblock('imessage')
 def cb_imessage(ctx, name=None, image=None, *args, **kwargs) -> Fragment:
+    declare_dependency(ctx, 'imessage')
     slugargs = ['-'.join(arg.split()) for arg in args]
     body_etree = cbE(
         "blockquote",
@@ -133,6 +146,7 @@ def _cssSlug(string) -> str:
 
 @customblock('discord')
 def cb_discord(ctx, *args, **kwargs) -> Fragment:
+    declare_dependency(ctx, 'discord')
     slugargs = ['-'.join(arg.split()) for arg in args if arg]
     body_etree: Fragment = cbE(
         "blockquote",
@@ -189,6 +203,7 @@ def cb_discord(ctx, *args, **kwargs) -> Fragment:
 
 @customblock('askblog')
 def cb_askblog(ctx, *args, **kwargs) -> Fragment:
+    declare_dependency(ctx, 'askblog')
     slugargs = ['-'.join(arg.split()) for arg in args]
     return cbE(
         "div",
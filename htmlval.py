@@ -1,48 +1,309 @@
 # -*- coding: utf8 -*-
 
+import html.parser
+import json
 import logging
-import bs4
+import os
+import posixpath
+import re
+import string
+import sys
+import urllib.parse
+import xml.etree.ElementTree as ET  # noqa: S405
+
 from pelican import signals
-from pelican.generators import ArticlesGenerator, PagesGenerator, TemplatePagesGenerator
+from pelican.generators import PagesGenerator
+
+try:
+    import gio_common
+except ImportError:
+    # PLUGIN_PATHS isn't on sys.path, so find gio_common next to this plugin
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    import gio_common
+from gio_common import cache, doctree, pipeline
+
+# Bump when what the visitor returns changes
+CACHE_VERSION = 2
+
+REPORT_VAR_NAME = "HTMLVAL_REPORT"
+
+BUDGET_VAR_NAME = "HTMLVAL_BUDGET"
+BUDGET_REPORT_VAR_NAME = "HTMLVAL_BUDGET_REPORT"
+BUDGET_METRICS = ("html_bytes", "data_uri_bytes", "media_elements", "external_scripts", "dom_nodes")
+
+# data: URIs in attributes and in CSS url()s. They have to start the value, so
+# "metadata:" or "data:" in text doesn't count.
+DATA_URI_RE = re.compile(r"""(?<=["'(=])data:[^"'\s)>]*""")
+
+
+# Pelican's intrasite link syntaxes for other documents
+FILENAME_PREFIXES = ("{filename}", "|filename|")
+# Pelican's other intrasite links ({static}, {tag}...), which Pelican checks itself
+INTRASITE_RE = re.compile(r"^[{|]\w+[|}]")
+
+# Settings whose urls are documents'. An unknown url that fits one of these is
+# a broken link; any other unknown url might be a listing or some other page.
+DOCUMENT_URL_SETTINGS = (
+    "ARTICLE_URL", "ARTICLE_LANG_URL", "PAGE_URL", "PAGE_LANG_URL",
+    "DRAFT_URL", "DRAFT_LANG_URL", "DRAFT_PAGE_URL", "DRAFT_PAGE_LANG_URL",
+)
+
+# What strftime directives in url settings can expand to
+STRFTIME_RES = {'Y': r"\d{4}", 'y': r"\d{2}", 'm': r"\d{1,2}", 'd': r"\d{1,2}", 'j': r"\d{1,3}"}
+
 
-TYPES_TO_PROCESS = [
-    "articles", "pages", "drafts",
-    "hidden_pages", "hidden_articles", 
-    "translations", "hidden_translations", "draft_translations", "drafts_translations"
-]
+def might_be_internal(href):
+    """Whether `href` could point somewhere on this site"""
+    if href.startswith(FILENAME_PREFIXES):
+        return True
+    if INTRASITE_RE.match(href):
+        return False
+    return urllib.parse.urlsplit(href).scheme in ("", "http", "https")
 
-def process_content(instance, generator=None):
+
+def url_pattern(template):
     """
-    Pelican callback
+    A regex for the url keys a url setting like ARTICLE_URL produces, and
+    whether it's specific enough to tell its urls from other pages'.
+    {slug}.html isn't: it fits archives.html too.
     """
-    if instance._content is None:
-        return
+    template = template.lstrip('/')
+    if template.endswith('index.html'):
+        template = template[:-len('index.html')]
+    template = template.rstrip('/')
 
-    # TODO: This is too slow
+    regex = []
+    literal = []
+    dated = False
+    for text, field, spec, __ in string.Formatter().parse(template):
+        regex.append(re.escape(text))
+        literal.append(text)
+        if field is None:
+            continue
+        if spec and "%" in spec:
+            dated = True
+            for part in re.split(r"(%.)", spec):
+                if part.startswith("%") and len(part) == 2:
+                    regex.append(STRFTIME_RES.get(part[1], r"[^/]+?"))
+                else:
+                    regex.append(re.escape(part))
+        else:
+            regex.append(r"[^/]+")
 
-    issues = []
+    # Separators and the extension don't set urls apart, words do
+    literal = re.sub(r"\.html?$", "", "".join(literal))
+    return re.compile("".join(regex)), dated or any(c.isalnum() for c in literal)
+
+
+def url_patterns(settings):
+    """
+    Regexes for document url keys, and for url keys of other generated pages
+    """
+    documents = []
+    others = []
+    for name, template in settings.items():
+        if not name.endswith("_URL") or not isinstance(template, str) or "{" not in template:
+            continue
+        if name == "STATIC_URL":
+            # Static files are looked up by url instead
+            continue
+        pattern, specific = url_pattern(template)
+        if name in DOCUMENT_URL_SETTINGS:
+            if specific:
+                documents.append(pattern)
+        else:
+            others.append(pattern)
+    return documents, others
+
+
+def url_key(path):
+    """Normalize a site-relative url path, so /a/b/, a/b and a/b/index.html match"""
+    path = urllib.parse.unquote(path).lstrip('/')
+    if path.endswith('index.html'):
+        path = path[:-len('index.html')]
+    return path.rstrip('/')
+
+
+class HtmlvalVisitor(pipeline.Visitor):
+    """
+    Collects element ids and links, and checks backlinks have a referent.
+
+    Links to other documents are checked once every document is in, against
+    an index of the ids in each document.
+    """
+    name = "htmlval"
+    read_only = True
+
+    def __init__(self):
+        # url key -> ids, source path -> ids
+        self.ids_by_url = {}
+        self.ids_by_source = {}
+        # (instance, issues, links) for each document, in order
+        self.documents = []
+        # (type, source path) of the documents in self.documents. Generators
+        # like chrono's read the same articles again, but each is checked once.
+        self.seen = set()
+        # Set up in finish: see url_patterns
+        self.document_urls = []
+        self.other_urls = []
+        self.static_urls = set()
+
+    def cached(self, ctx):
+        results_cache = cache.get_cache("htmlval", CACHE_VERSION, ctx.settings)
+        return results_cache.get(ctx.original_content, default=pipeline.MISS)
+
+    def store(self, ctx, result):
+        results_cache = cache.get_cache("htmlval", CACHE_VERSION, ctx.settings)
+        results_cache.set(ctx.original_content, result)
+
+    def begin(self, ctx):
+        return (set(), [])
+
+    def visit(self, ctx, state, tag):
+        element_ids, anchors = state
+        if tag.get('id') is not None:
+            element_ids.add(tag['id'])
+        if tag.name == "a" and tag.get('href'):
+            anchors.append(tag)
+
+    def end(self, ctx, state):
+        element_ids, anchors = state
+        issues = []
+        # (href, anchor html) of links that might point to other documents
+        links = []
+
+        for anchor in anchors:
+            url = anchor['href']
+
+            if url.startswith("#"):
+                if url != "#" and url[1:] not in element_ids:
+                    issues.append(f"'{anchor}' backlink has no referent {url[1:]!r} in {sorted(element_ids)!r}")
+            elif might_be_internal(url):
+                links.append((url, str(anchor)))
+
+        # Hash text isn't respected by first child, so this catches inline links too.
+        # for anchor in soup_doc.select("blockquote > p > a:first-child:not(.cite)"):
+        #     issues.append(f"Blockquote begins with plain link, probably meant to be a citation: {anchor}")
+
+        return issues, sorted(element_ids), links
+
+    def apply(self, instance, generator, result):
+        key = (type(instance), instance.relative_source_path)
+        if key in self.seen:
+            return
+        self.seen.add(key)
+
+        issues, element_ids, links = result
+        element_ids = set(element_ids)
+
+        self.ids_by_source[instance.relative_source_path] = element_ids
+        for url in (instance.url, instance.save_as):
+            if url:
+                self.ids_by_url[url_key(url)] = element_ids
+
+        self.documents.append((instance, issues + summary_issues(instance, generator), links))
 
-    # strainer = bs4.SoupStrainer("a")
-    soup_doc = bs4.BeautifulSoup(instance._content, 'html.parser')  # , parse_only=strainer)
-    element_ids = {h['id'] for h in soup_doc.findAll(id=True)}
+    def resolve(self, instance, href):
+        """
+        The ids of the document `href` points to, and the fragment, or
+        (None, fragment) if it's not a document, like an external link or a
+        listing. Raises KeyError for {filename} links to files that don't
+        exist, and for urls where a document should be but isn't.
+        """
+        for prefix in FILENAME_PREFIXES:
+            if href.startswith(prefix):
+                path, __, fragment = href[len(prefix):].partition("#")
+                path = urllib.parse.unquote(path.split("?")[0])
+                if path.startswith("/"):
+                    path = path[1:]
+                else:
+                    path = posixpath.join(posixpath.dirname(instance.relative_source_path), path)
+                path = posixpath.normpath(path)
+                if path in self.ids_by_source:
+                    return self.ids_by_source[path], fragment
+                # Pelican links {filename} to static files too, like images
+                if path in (instance._context or {}).get('static_content', {}):
+                    return None, fragment
+                raise KeyError(path)
+
+        siteurl = instance.settings.get('SITEURL') or ''
+        if siteurl and href.startswith(siteurl + "/"):
+            href = href[len(siteurl):]
+        parts = urllib.parse.urlsplit(href)
+        if parts.scheme or parts.netloc:
+            # Somewhere else entirely
+            return None, parts.fragment
+
+        path = parts.path
+        site_path = urllib.parse.urlsplit(siteurl).path.rstrip('/')
+        if site_path and path.startswith(site_path + "/"):
+            path = path[len(site_path):]
+        if not path.startswith("/"):
+            path = posixpath.join(posixpath.dirname(instance.url or ''), path)
+        key = url_key(posixpath.normpath(path))
+        if key in self.ids_by_url:
+            return self.ids_by_url[key], parts.fragment
+
+        if key not in self.static_urls and not any(p.fullmatch(key) for p in self.other_urls):
+            if any(p.fullmatch(key) for p in self.document_urls):
+                raise KeyError(key)
+        logging.debug(f"htmlval: Not checking {href!r} in {instance.relative_source_path}, it isn't a document url")
+        return None, parts.fragment
+
+    def link_issues(self, instance, links):
+        issues = []
+        for href, anchor in links:
+            try:
+                element_ids, fragment = self.resolve(instance, href)
+            except KeyError:
+                if href.startswith(FILENAME_PREFIXES):
+                    issues.append(f"'{anchor}' links to a file that doesn't exist")
+                else:
+                    issues.append(f"'{anchor}' links to a document that doesn't exist")
+                continue
+            if element_ids is not None and fragment and fragment not in element_ids:
+                issues.append(f"'{anchor}' has no referent {fragment!r} in the linked document")
+        return issues
 
-    for anchor in soup_doc.findAll("a", href=True):
-        url = anchor['href']
+    def finish(self):
+        if self.documents:
+            instance = self.documents[0][0]
+            self.document_urls, self.other_urls = url_patterns(instance.settings)
+            self.static_urls = {
+                url_key(static.url)
+                for static in (instance._context or {}).get('static_content', {}).values()
+            }
 
-        if url.startswith("#") and url != "#":
-            if url[1:] not in element_ids:
-                issues.append(f"'{anchor}' backlink has no referent {url[1:]!r} in {sorted(element_ids)!r}")
+        results = []
+        for instance, issues, links in self.documents:
+            issues = issues + self.link_issues(instance, links)
+            if issues:
+                logging.error(f"HTML validation errors in {instance.relative_source_path}:" + "\n" + "\n".join(issues))
+            results.append((instance, issues))
 
-    # Hash text isn't respected by first child, so this catches inline links too.
-    # for anchor in soup_doc.select("blockquote > p > a:first-child:not(.cite)"):
-    #     issues.append(f"Blockquote begins with plain link, probably meant to be a citation: {anchor}")
+        if results:
+            report_path = results[0][0].settings.get(REPORT_VAR_NAME)
+            if report_path:
+                write_report(report_path, results)
+
+        self.ids_by_url.clear()
+        self.ids_by_source.clear()
+        self.documents.clear()
+        self.seen.clear()
+        self.static_urls.clear()
+
+
+def summary_issues(instance, generator=None):
+    issues = []
 
     if instance.status != "draft" and not isinstance(generator, PagesGenerator):
         if instance.summary:
             SUMMARY_MAX_LENGTH = instance.settings.get('SUMMARY_MAX_LENGTH')
 
-            summary_soup = bs4.BeautifulSoup(instance.summary, 'html.parser')
-            summary_length = len(summary_soup.text)
+            summary_length = summary_cache(instance.settings).fetch(
+                lambda: len(doctree.soup(instance.summary).text),
+                instance.summary, "summary_length"
+            )
             if SUMMARY_MAX_LENGTH and summary_length > SUMMARY_MAX_LENGTH:
                 if instance.content != instance.summary:
                     issues.append(f"Summary length is {summary_length}/{SUMMARY_MAX_LENGTH}")
@@ -54,54 +315,165 @@ def process_content(instance, generator=None):
 
         else:
             issues.append("Missing summary")
-        
-    if issues:
-        logging.error(f"HTML validation errors in {instance.relative_source_path}:" + "\n" + "\n".join(issues))
 
+    return issues
 
-def all_generators_finalized(generators):
-    # Process the articles and pages
 
-    document_generators = [ArticlesGenerator, PagesGenerator, TemplatePagesGenerator]
+def summary_cache(settings):
+    return cache.get_cache("htmlval", CACHE_VERSION, settings)
 
-    for generator in generators:
-        if any(isinstance(generator, t) for t in document_generators):
-            documents = sum([
-                getattr(generator, attr, None)
-                for attr in TYPES_TO_PROCESS
-                if getattr(generator, attr, None)
-            ], [])
-            for document in documents:
-                process_content(document, generator)
-        else:
-            logging.debug(f"Renderdeps: Unhandled generator {generator}")
 
-def article_writer_finalized(generator, writer):
-    # Process the articles and pages
+def write_report(path, results):
+    """
+    Write `(instance, issues)` results to `path`: JUnit XML if it ends in
+    .xml, JSON otherwise
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    if path.endswith(".xml"):
+        suite = ET.Element("testsuite", {
+            'name': "htmlval",
+            'tests': str(len(results)),
+            'failures': str(sum(1 for __, issues in results if issues)),
+            'errors': "0",
+        })
+        for instance, issues in results:
+            case = ET.SubElement(suite, "testcase", {
+                'classname': "htmlval",
+                'name': instance.relative_source_path,
+            })
+            if issues:
+                failure = ET.SubElement(case, "failure", {'message': f"{len(issues)} HTML validation errors"})
+                failure.text = "\n".join(issues)
+        ET.ElementTree(suite).write(path, encoding="utf-8", xml_declaration=True)
+    else:
+        data = {
+            'documents': len(results),
+            'failures': sum(1 for __, issues in results if issues),
+            'results': [
+                {'source_path': instance.relative_source_path, 'url': instance.url, 'issues': issues}
+                for instance, issues in results
+            ],
+        }
+        with open(path, "w", encoding="utf-8") as fp:
+            json.dump(data, fp, indent=1)
+
+    logging.info(f"HTML validation report written to {path}")
+
+
+class PageWeight(html.parser.HTMLParser):
+    """Counts elements in a rendered page without building a tree"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.dom_nodes = 0
+        self.media_elements = 0
+        self.external_scripts = 0
+
+    def handle_starttag(self, tag, attrs):
+        self.dom_nodes += 1
+        if tag in ("img", "video"):
+            self.media_elements += 1
+        elif tag == "script" and dict(attrs).get('src'):
+            self.external_scripts += 1
+
+
+def measure_page(page_html):
+    counter = PageWeight()
+    counter.feed(page_html)
+    counter.close()
+    return {
+        'html_bytes': len(page_html.encode('utf-8')),
+        'data_uri_bytes': sum(len(m.group(0)) for m in DATA_URI_RE.finditer(page_html)),
+        'media_elements': counter.media_elements,
+        'external_scripts': counter.external_scripts,
+        'dom_nodes': counter.dom_nodes,
+    }
+
+
+# (output path, source path, metrics) of each page written this build
+page_weights = []
+
+
+def content_written(path, context):
+    """
+    Pelican callback
+    """
+    if not context.get(BUDGET_VAR_NAME) or not path.endswith((".html", ".htm")):
+        return
+
+    with open(path, encoding="utf-8") as fp:
+        metrics = measure_page(fp.read())
+
+    document = context.get('article') or context.get('page')
+    source_path = getattr(document, 'relative_source_path', None)
+    page_weights.append((os.path.relpath(path, context.get('OUTPUT_PATH', '.')), source_path, metrics))
+
+
+def over_budget(metrics, budget):
+    """{metric: (value, limit)} for every metric over its limit"""
+    return {
+        name: (metrics[name], limit)
+        for name, limit in budget.items()
+        if limit is not None and metrics.get(name, 0) > limit
+    }
+
+
+def check_budgets(pelican_object):
+    """
+    Pelican callback
+    """
+    settings = pelican_object.settings
+    budget = settings.get(BUDGET_VAR_NAME)
+    if not budget:
+        return
+
+    for name in budget:
+        if name not in BUDGET_METRICS:
+            logging.warning(f"Unknown {BUDGET_VAR_NAME} metric {name!r}, expected one of {BUDGET_METRICS}")
+
+    offenders = []
+    for path, source_path, metrics in page_weights:
+        over = over_budget(metrics, budget)
+        if over:
+            worst = max(value / max(limit, 1) for value, limit in over.values())
+            offenders.append({
+                'path': path,
+                'source_path': source_path,
+                'worst_ratio': worst,
+                'over': {name: {'value': value, 'limit': limit} for name, (value, limit) in over.items()},
+                'metrics': metrics,
+            })
+    # Worst offenders first
+    offenders.sort(key=lambda o: o['worst_ratio'], reverse=True)
+
+    for offender in offenders:
+        details = ", ".join(f"{name} {o['value']}/{o['limit']}" for name, o in offender['over'].items())
+        logging.warning(f"Page weight over budget in {offender['path']}: {details}")
+
+    report_path = settings.get(BUDGET_REPORT_VAR_NAME)
+    if report_path:
+        directory = os.path.dirname(report_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(report_path, "w", encoding="utf-8") as fp:
+            json.dump({
+                'budget': budget,
+                'pages': len(page_weights),
+                'offenders': offenders,
+            }, fp, indent=1)
+        logging.info(f"Page weight report written to {report_path}")
 
-    documents = sum([
-        getattr(generator, attr, None)
-        for attr in TYPES_TO_PROCESS
-        if getattr(generator, attr, None)
-    ], [])
-    for document in documents:
-        process_content(document, generator)
+    page_weights.clear()
 
 
 def register():
     """
     Part of Pelican API
     """
-    # signals.content_object_init.connect(content_object_init)
-
-    # signals.all_generators_finalized.connect(all_generators_finalized)
-    signals.article_writer_finalized.connect(article_writer_finalized)
-    signals.page_writer_finalized.connect(article_writer_finalized)
-
-    # logging.info("Register")
-    # signals.article_generator_write_article.connect(
-    #     lambda gen, content: process_content(content, gen)
-    # )
-    # signals.page_generator_write_page.connect(
-    #     lambda gen, content: process_content(content, gen)
-    # )
+    gio_common.register()
+    pipeline.register_visitor(HtmlvalVisitor())
+    signals.content_written.connect(content_written)
+    signals.finalized.connect(check_budgets)
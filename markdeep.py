@@ -2,6 +2,8 @@ from pelican import signals
 from pelican.readers import BaseReader
 import os
 
+import blinker
+
 FILE_EXTENSIONS = ['md.html', 'mdhtml']
 
 MARKDEEP_FOOTER = """<!-- Markdeep footer -->
@@ -12,6 +14,9 @@ MARKDEEP_FOOTER = """<!-- Markdeep footer -->
 # <style class="fallback">body{visibility:hidden;white-space:pre;font-family:monospace}</style>
 # <script>window.alreadyProcessedMarkdeep||(document.body.style.visibility="visible")</script>
 
+# Only renderdeps listens to this, see gio_common.deps
+render_deps = blinker.signal("gio_common.render_deps")
+
 # Create a new reader class, inheriting from the pelican.reader.BaseReader
 class MarkdeepReader(BaseReader):
     enabled = True  # Yeah, you probably want that :-)
@@ -38,7 +43,12 @@ class MarkdeepReader(BaseReader):
             for key, value in metadata.items()
         }
 
-        full_body = f'<pre class="markdeep">{full_body}</pre>{MARKDEEP_FOOTER}'
+        # If renderdeps is running and has a "markdeep" entry, it brings the footer instead
+        declared = render_deps.send(parsed_metadata, names=["markdeep"], settings=self.settings)
+        if any(names for __, names in declared):
+            full_body = f'<pre class="markdeep">{full_body}</pre>'
+        else:
+            full_body = f'<pre class="markdeep">{full_body}</pre>{MARKDEEP_FOOTER}'
 
         return full_body, parsed_metadata
 
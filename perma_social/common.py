@@ -1,27 +1,87 @@
 
 import collections
+import contextlib
 import dataclasses
 import json
 import logging
 import os
 import re
+import sys
 import urllib
 import xml.etree.ElementTree as ET  # noqa: S405
 from typing import Callable, Iterable, List, Mapping, Optional, Self, Tuple, Union
 
-import bs4
-import jinja2
+import blinker
 import markdown
 import markdown.inlinepatterns
 
-env = jinja2.Environment(undefined=jinja2.StrictUndefined)  # noqa: S701
-envUnstrict = jinja2.Environment()  # noqa: N816, S701
+# Network and parsing libraries (requests, bs4, tweepy...) are imported where
+# they're used, so registering the plugin stays cheap when every post is cached
+
+
+def profile_phase(name, plugin=None):
+    # Only profile if gio_common is loaded, don't load it ourselves
+    profiling = sys.modules.get('gio_common.profiling')
+    if profiling is None:
+        return contextlib.nullcontext()
+    return profiling.phase(name, plugin)
+
+
+# Only renderdeps listens to this, see gio_common.deps
+render_deps = blinker.signal("gio_common.render_deps")
+
+
+def declare_dependency(md, name):
+    render_deps.send(md, names=[name])
+
+
+class LazyEnvironment:
+    """
+    Stands in for a jinja2.Environment, which is only created (and its
+    templates compiled) when a template is first rendered.
+    """
+
+    def __init__(self, strict=False):
+        self.strict = strict
+        self.filters = {}
+        self._env = None
+
+    @property
+    def environment(self):
+        if self._env is None:
+            import jinja2
+            undefined = jinja2.StrictUndefined if self.strict else jinja2.Undefined
+            self._env = jinja2.Environment(undefined=undefined)  # noqa: S701
+            self._env.filters.update(self.filters)
+            # Filters registered from now on go straight to the environment
+            self.filters = self._env.filters
+        return self._env
+
+    def from_string(self, source):
+        return LazyTemplate(self, source)
+
+
+class LazyTemplate:
+    def __init__(self, env, source):
+        self.env = env
+        self.source = source
+        self._template = None
+
+    def render(self, *args, **kwargs):
+        if self._template is None:
+            self._template = self.env.environment.from_string(self.source)
+        return self._template.render(*args, **kwargs)
+
+
+env = LazyEnvironment(strict=True)
+envUnstrict = LazyEnvironment()  # noqa: N816
 
 logging.basicConfig(level=logging.WARNING)
 
 
 def summarize_html(html_code) -> str:
     # logging.warning(html_code)
+    import bs4
     soup = bs4.BeautifulSoup(html_code, features="lxml")
     return soup.text
 
@@ -121,7 +181,8 @@ class PermaSocial:
         last_exception: Exception = NotImplemented
         for getter in self.JSON_GETTERS:
             try:
-                (json_obj, did_new_work) = getter(self, post_reference, reason=reason)
+                with profile_phase(f"fetch {getter.__name__}", plugin="perma_social"):
+                    (json_obj, did_new_work) = getter(self, post_reference, reason=reason)
                 # = (getter.__name__ != self.getPostJsonCached.__name__)
 
                 self.seasonPostReference(json_obj, post_reference)
@@ -177,7 +238,8 @@ class PermaSocial:
                     src_url_plain: str = src_url.split('?')[0]
                     if not os.path.isfile(media_dest_path):
                         logging.warning(f"DL {src_url_plain} -> {media_dest_path}")
-                        urlretrieve(src_url_plain, media_dest_path)
+                        with profile_phase("fetch media", plugin="perma_social"):
+                            urlretrieve(src_url_plain, media_dest_path)
                 elif callable(src_url):
                     src_url(media_dest_path)
                 else:
@@ -224,9 +286,11 @@ class PermaSocial:
                 ])
                 try:
                     string = superself.POST_HTML_TEMPLATE.render(extra_attrs=extra_attrs, **matches, **json_obj)  # type: ignore[arg-type]
+                    declare_dependency(self.md, superself.NOUN_POST)
                     # return ET.fromstring(string), m.start(0), m.end(0)
+                    # The placeholder for the stashed html, not an element
                     return (
-                        ET.fromstring(self.md.htmlStash.store(string)),  # noqa: S314
+                        self.md.htmlStash.store(string),
                         int(m.start(0)),
                         int(index)  # type: ignore
                     )
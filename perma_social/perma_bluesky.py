@@ -10,15 +10,11 @@ import re
 import traceback
 from typing import Any, Callable, Dict, Iterable, Mapping, Optional, Self, Tuple, Union
 
-import bs4
-import requests
 import urllib
 from .common import PermaSocial, PostReference, WorkResult, env, envUnstrict
 
 logging.basicConfig(level=logging.WARNING)
 
-import chitose  # type: ignore[import]
-
 
 class PermaBluesky(PermaSocial):
     NOUN_POST = "skeet"
@@ -62,7 +58,7 @@ class PermaBluesky(PermaSocial):
 </blockquote>"""))
 
     @property
-    def api(self) -> chitose.BskyAgent: # type: ignore
+    def api(self) -> "chitose.BskyAgent": # type: ignore  # noqa: F821
         if self._api is None:
             # traceback.print_stack()
             self.login()
@@ -71,6 +67,8 @@ class PermaBluesky(PermaSocial):
 
     def login(self, instance="bsky.social") -> None:
         try:
+            import chitose  # type: ignore[import]
+
             rc = netrc.netrc()
             (BSKY_USER, _, BSKY_PASSWD) = rc.authenticators(instance)
 
@@ -5,8 +5,6 @@ import os
 import re
 from typing import Iterable, Optional, Self, Tuple
 
-import bs4
-import requests
 from .common import PermaSocial, PostReference, WorkResult, env
 
 logging.basicConfig(level=logging.WARNING)
@@ -110,6 +108,8 @@ class PermaMastodon(PermaSocial):
             raise e
 
     def getTootJsonApi(self: Self, post_reference: PostRef, reason="") -> WorkResult:
+        import requests
+
         try:
             resp = requests.get(f"https://{post_reference.instance}/api/v1/statuses/{post_reference.post_id}")
             status_json = resp.json()
@@ -131,6 +131,7 @@ class PermaMastodon(PermaSocial):
             yield self.PostRef(user_id=None, post_id=parent_id, instance=post_reference.instance)
 
         # "Quote" support
+        import bs4
         body_soup = bs4.BeautifulSoup(post_json['content'], features="lxml")
         for link in body_soup.findAll("a"):
             if match := re.match(self.LINK_RE, link['href']):
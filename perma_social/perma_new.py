@@ -5,8 +5,6 @@ import os
 import re
 from typing import Callable, Iterable, Optional, Self, Tuple, Union
 
-import bs4
-import requests
 from .common import PermaSocial, PostReference, WorkResult, env
 
 logging.basicConfig(level=logging.WARNING)
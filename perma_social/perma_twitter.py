@@ -4,23 +4,32 @@ import urllib
 import os
 import functools
 import typing
-import requests
 import html
 import sys
 import re
-import bs4
 import subprocess  # noqa: S404
-import tweepy  # type: ignore[import]
-import timeout_decorator  # type: ignore[import]
 
 import xml.etree.ElementTree as ET  # noqa: S405
-import gallery_dl  # type: ignore[import]
 
 from .common import PermaSocial, PostReference, WorkResult, env, envUnstrict
 
+# requests, bs4, tweepy, timeout_decorator and gallery_dl are imported when a
+# tweet actually has to be fetched, not when the plugin is loaded
+
 logging.basicConfig(level=logging.WARNING)
 
 
+def lazy_timeout(seconds):
+    """timeout_decorator.timeout, without importing it until the call"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            import timeout_decorator  # type: ignore[import]
+            return timeout_decorator.timeout(seconds, use_signals=False)(fn)(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
 def tw_entities(text, id, entities, extended_entities) -> str:
     entities.update(extended_entities)
 
@@ -198,6 +207,7 @@ class PermaTwitter(PermaSocial):
     def login(self: typing.Self) -> None:
         tweepy_config_path = os.path.abspath("./tweepy_config.py")
         sys.path.insert(0, os.path.dirname(tweepy_config_path))
+        import tweepy  # type: ignore[import]
         import tweepy_config
 
         self.NITTR_HOST = tweepy_config.NITTR_HOST or "https://nitter.net"
@@ -246,6 +256,8 @@ class PermaTwitter(PermaSocial):
             nittr_url = '/'.join([self.NITTR_HOST, json_obj['user']['screen_name'], 'status', json_obj['id_str']])
             logging.warning(f"Using nittr to get full_text for {json_obj['id_str']} from {nittr_url=} b/c {json_obj.get('full_text_orig')=}")
             # logging.warning(json_obj)
+            import bs4
+            import requests
             resp = requests.get(nittr_url, headers={'User-Agent': 'curl/8.0.1'})
             try:
                 resp.raise_for_status()
@@ -281,6 +293,7 @@ class PermaTwitter(PermaSocial):
     def getTweetJsonGalleryDl(self: typing.Self, post_reference: PostReference, reason="") -> WorkResult:
         # TwitterTweetExtractor.tweets of <gallery_dl.extractor.twitter.TwitterTweetExtractor
         # Configured with system defaults, probably %APPDATA%\gallery-dl\config.json
+        import gallery_dl  # type: ignore[import]
         gallery_dl.config.load()
         extractor = gallery_dl.extractor.find(f"https://twitter.com/{post_reference.user_id}/status/{post_reference.post_id}")
         extractor.initialize()
@@ -305,6 +318,9 @@ class PermaTwitter(PermaSocial):
         return WorkResult(json_obj, nontrivial=True)  # (json_obj_main, json_objs)
 
     def getTweetJsonNittr(self: typing.Self, post_reference: PostReference, reason="") -> WorkResult:
+        import bs4
+        import requests
+
         if not self.NITTR_HOST:
             raise NotImplementedError("Tweet needs note_tweet saved, but no NITTR_HOST set!")
 
@@ -403,6 +419,9 @@ class PermaTwitter(PermaSocial):
             raise ValueError(nittr_url)
 
     def getTweetInternetArchive(self: typing.Self, post_reference: PostReference, reason="") -> WorkResult:
+        import bs4
+        import requests
+
         ia_url = f"http://web.archive.org/web/1im_/https://twitter.com/{post_reference.user_id}/status/{post_reference.post_id}"
         resp = requests.get(ia_url)
 
@@ -447,7 +466,7 @@ class PermaTwitter(PermaSocial):
     JSON_GETTERS = [
         *PermaSocial.JSON_GETTERS,
         # getPostJsonTweepy,
-        timeout_decorator.timeout(10, use_signals=False)(getTweetJsonGalleryDl),
+        lazy_timeout(10)(getTweetJsonGalleryDl),
         # getTweetJsonNittr,
         getTweetInternetArchive,
         getTweetJsonGalleryDl
@@ -3,7 +3,7 @@
 import os.path
 import re
 import itertools
-from bs4 import BeautifulSoup
+import sys
 from codecs import open
 
 try:
@@ -15,9 +15,20 @@ import logging
 from pelican import signals
 from pelican.generators import CachingGenerator
 
+try:
+    import gio_common
+except ImportError:
+    # PLUGIN_PATHS isn't on sys.path, so find gio_common next to this plugin
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    import gio_common
+from gio_common import cache, doctree, pipeline
+
 
 logger = logging.getLogger(__name__)
 
+# Bump when the shape of cached link lists changes
+CACHE_VERSION = 1
+
 def unTypography(string):
     ret = string
     # Uncaught whitespace
@@ -95,19 +106,22 @@ class RelatedReadingAggregateGenerator(CachingGenerator):
         if getattr(page, 'status', 'published') != 'published':
             return
 
-        soup_title = BeautifulSoup(page.title, 'html.parser')
+        soup_title = doctree.soup(page.title)
         page_title = unTypography(soup_title.get_text(' ', strip=True))
 
-        soup_text = BeautifulSoup(page._content, 'html.parser')
+        # Normally collected while the pipeline walked the document
+        page_links = getattr(page, 'related_reading_links', None)
+        if page_links is None:
+            soup_text = doctree.get(page)
 
-        page_links = []
+            page_links = []
 
-        anchors = itertools.chain(
-            soup_text.find_all("a", class_="related-reading"),
-            soup_text.select(".related-reading a")
-        )
-        for anchor in anchors:
-            page_links.append(dict(text=anchor.text, href=anchor.get('href')))
+            anchors = itertools.chain(
+                soup_text.find_all("a", class_="related-reading"),
+                soup_text.select(".related-reading a")
+            )
+            for anchor in anchors:
+                page_links.append(dict(text=anchor.text, href=anchor.get('href')))
 
         page_category = page.category.name if getattr(page, 'category', 'None') != 'None' else ''
 
@@ -128,7 +142,7 @@ class RelatedReadingAggregateGenerator(CachingGenerator):
         # Takes a url to a template page and creates a search node
 
         srcfile = open(os.path.join(self.output_path, srclink), encoding='utf-8')
-        soup = BeautifulSoup(srcfile, 'html.parser')
+        soup = doctree.soup(srcfile)
 
         # Only printable characters
         while True:
@@ -162,8 +176,48 @@ class RelatedReadingAggregateGenerator(CachingGenerator):
         return node
 
 
+class RelatedReadingVisitor(pipeline.Visitor):
+    """
+    Collects related reading links during the shared document walk
+    """
+    name = "related_reading"
+    tags = ("a",)
+    read_only = True
+
+    def cached(self, ctx):
+        links_cache = cache.get_cache("related_reading", CACHE_VERSION, ctx.settings)
+        return links_cache.get(ctx.original_content, default=pipeline.MISS)
+
+    def store(self, ctx, links):
+        links_cache = cache.get_cache("related_reading", CACHE_VERSION, ctx.settings)
+        links_cache.set(ctx.original_content, links)
+
+    def begin(self, ctx):
+        # Links classed .related-reading, and links inside .related-reading
+        return ([], [])
+
+    def visit(self, ctx, state, anchor):
+        classed, contained = state
+        if "related-reading" in anchor.get('class', []):
+            classed.append(anchor)
+        if any("related-reading" in parent.get('class', []) for parent in anchor.parents):
+            contained.append(anchor)
+
+    def end(self, ctx, state):
+        classed, contained = state
+        return [
+            dict(text=anchor.text, href=anchor.get('href'))
+            for anchor in itertools.chain(classed, contained)
+        ]
+
+    def apply(self, instance, generator, links):
+        instance.related_reading_links = links
+
+
 def get_generators(generators):
     return RelatedReadingAggregateGenerator
 
 def register():
+    gio_common.register()
+    pipeline.register_visitor(RelatedReadingVisitor())
     signals.get_generators.connect(get_generators)
@@ -1,15 +1,39 @@
 # -*- coding: utf8 -*-
 
+import copy
+import hashlib
+import html
+import json
 import logging
-from bs4 import BeautifulSoup
+import os
+import posixpath
+import re
+import sys
+import bs4
+
 from pelican import signals
-from pelican.generators import ArticlesGenerator, PagesGenerator, TemplatePagesGenerator
+from pelican.utils import get_relative_path, path_to_url
+
+try:
+    import gio_common
+except ImportError:
+    # PLUGIN_PATHS isn't on sys.path, so find gio_common next to this plugin
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    import gio_common
+from gio_common import deps, doctree, pipeline
+
+RENDERDEPS_USE_SOUP_DEFAULT = True
 
-import threading
-import queue
+MANIFEST_VAR_NAME = "RENDERDEPS_MANIFEST"
+MANIFEST_DEFAULT_PATH = "renderdeps/manifest.json"
+PRELOAD_VAR_NAME = "RENDERDEPS_PRELOAD"
 
-MAX_THREADS = 1
-RENDERDEPS_USE_SOUP_DEFAULT = False
+# Asset urls in references are {static} links, which Pelican resolves wherever
+# the content is rendered, following SITEURL and RELATIVE_URLS
+STATIC_PREFIX = "{static}/"
+
+# Inline scripts with these types can be moved to a file
+SCRIPT_TYPES = {"", "text/javascript", "application/javascript", "text/ecmascript", "module"}
 
 def makeStrmatches(args, kwargs):
     tagmatch = f"<{args[0]} " if len(args) > 0 else ""
@@ -25,107 +49,468 @@ def makeStrmatches(args, kwargs):
     else:
         return [tagmatch]
 
-def process_dependencies(article, generator=None):
+
+def entries(dependencies):
     """
-    Pelican callback
+    (selector, script_include, name) for each RENDER_DEPS item. Items that are
+    only ever included when declared have no selector.
     """
+    return [(entry[0], entry[1], deps.entry_name(entry)) for entry in dependencies]
 
-    # TODO: This is far too slow.
 
-    if article._content is None:
-        logging.warning(f"{article.title} is empty!")
-        return
+def overlaps(patterns):
+    """Whether one pattern could start partway through a match of another"""
+    for a in patterns:
+        for i in range(1, len(a)):
+            tail = a[i:]
+            if any(b.startswith(tail) or tail.startswith(b) for b in patterns):
+                return True
+    return False
+
+
+def trieRegex(patterns):
+    """
+    An alternation of `patterns` with common prefixes factored out, so re can
+    search for the literal prefix instead of trying every alternative everywhere.
+    Optional suffixes are greedy, so the longest pattern that starts somewhere wins.
+    """
+    trie = {}
+    for pattern in patterns:
+        node = trie
+        for char in pattern:
+            node = node.setdefault(char, {})
+        node[None] = None
 
-    settings = article.settings
-    dependencies = settings.get("RENDER_DEPS", [])
-    use_soup = settings.get("RENDERDEPS_USE_SOUP", RENDERDEPS_USE_SOUP_DEFAULT)
+    def emit(node):
+        alternatives = [re.escape(char) + emit(child) for char, child in node.items() if char is not None]
+        if not alternatives:
+            return ""
+        body = alternatives[0] if len(alternatives) == 1 else f"(?:{'|'.join(alternatives)})"
+        return f"(?:{body})?" if None in node else body
 
-    dirty = False
+    return emit(trie)
 
-    for (args, kwargs, *strmatches_), dep in dependencies:
-        # logging.debug(f"Checking for '{args} {kwargs}'")
 
-        if use_soup:
-            soup = BeautifulSoup(article._content, 'html.parser')
-            if match := soup.find(*args, **kwargs):
-                logging.info("Inserting dependency " + repr(dep) + " into " + repr(article.slug) + " matching" + repr(match))
-                soup.append(BeautifulSoup(dep, 'html.parser'))
-                dirty = True
+class DependencyMatcher():
+    """
+    Every dependency's strmatches compiled into one regex, so that each
+    document is scanned once instead of once per string
+    """
+
+    def __init__(self, dependencies):
+        self.deps = []
+        for selector, dep, name in entries(dependencies):
+            if selector is None:
+                strmatches = []
+            else:
+                args, kwargs, *strmatches_ = selector
+                strmatches = strmatches_ or makeStrmatches(args, kwargs)
+            self.deps.append((strmatches, dep))
+
+        self.patterns = {s for strmatches, __ in self.deps for s in strmatches}
+        # A match is the longest pattern starting there, so the others that
+        # start there are its prefixes
+        self.prefixes = {
+            a: [b for b in self.patterns if a.startswith(b)]
+            for a in self.patterns
+        }
+        alternation = trieRegex(self.patterns)
+        if overlaps(self.patterns):
+            # Try every position, not just the ones after the last match
+            self.regex = re.compile(f"(?=({alternation}))")
         else:
-            strmatches = strmatches_ or makeStrmatches(args, kwargs)
-            if any(s in article._content for s in strmatches):
-                logging.debug(f"Matched '{strmatches}'")
-                article._content += dep
-                # just chuck it in
-
-    if use_soup and dirty:
-        article._content = str(soup)
-    else:
-        # logging.debug("No dependencies in " + repr(article.slug))
-        pass
-    return
-
-
-TYPES_TO_PROCESS = [
-    "articles", "pages", "drafts",
-    "hidden_pages", "hidden_articles", 
-    "translations", "hidden_translations", "draft_translations", "drafts_translations"
-]
-
-
-def link_source_files(generator):
-    """
-    Processes each article/page object and formulates copy from and copy
-    to destinations, as well as adding a source file URL as an attribute.
-    """
-    # Get all attributes from the generator that are articles or pages
-
-def add_deps(generators):
-    # Process the articles and pages
-
-    THREADED = MAX_THREADS > 1
-
-    if THREADED:
-        q = queue.Queue()
-
-        class Worker(threading.Thread):
-            def __init__(self, fn, *args, **kwargs):
-                self.fn = fn
-                super().__init__(*args, **kwargs)
-
-            def run(self):
-                while True:
-                    try:
-                        work = q.get(timeout=3)  # 3s timeout
-                    except queue.Empty:
-                        return
-                    self.fn(*work)
-                    q.task_done()
-
-    document_generators = [ArticlesGenerator, PagesGenerator, TemplatePagesGenerator]
-
-    for generator in generators:
-        if any(isinstance(generator, t) for t in document_generators):
-            documents = sum([
-                getattr(generator, attr, None)
-                for attr in TYPES_TO_PROCESS
-                if getattr(generator, attr, None)
-            ], [])
-            for document in documents:
-                if THREADED:
-                    work = (document, generator)
-                    q.put_nowait(work)
-                else:
-                    process_dependencies(document, generator)
+            self.regex = re.compile(f"({alternation})")
+        self.longest = max(map(len, self.patterns), default=0)
+
+    def found(self, content):
+        found = set()
+        if not self.patterns:
+            return found
+        for match in self.regex.finditer(content):
+            found.update(self.prefixes[match.group(1)])
+            if len(found) == len(self.patterns):
+                break
+        return found
+
+    def match(self, content, included=()):
+        """
+        Yield the index of each dependency `content` needs, in order, as if
+        each dep were appended to the content before looking for the next.
+        The `included` ones are needed regardless.
+        """
+        if any(strmatches and i not in included for i, (strmatches, dep) in enumerate(self.deps)):
+            found = self.found(content)
         else:
-            logging.debug(f"Renderdeps: Unhandled generator {generator}")
+            # Nothing left to look for
+            found = set()
+        # Appended deps, and the end of the content a match could straddle
+        appended = ""
+        for i, (strmatches, dep) in enumerate(self.deps):
+            if i in included or any(s in found for s in strmatches) or (appended and any(s in appended for s in strmatches)):
+                yield i
+                if not appended:
+                    appended = content[-(self.longest - 1):] if self.longest > 1 else ""
+                appended += dep
+
+
+def tagNames(args, kwargs):
+    """The tag names a search pattern can match, or None for any tag"""
+    name = args[0] if len(args) > 0 else kwargs.get('name')
+    if isinstance(name, str):
+        return {name.lower()}
+    if isinstance(name, (list, tuple, set)) and name and all(isinstance(n, str) for n in name):
+        return {n.lower() for n in name}
+    return None
+
+
+class SoupMatcher():
+    """
+    Every dependency's search pattern as a SoupStrainer, and its markup
+    parsed and serialized once
+    """
+
+    def __init__(self, dependencies):
+        self.strainers = []
+        self.fragments = []
+        names = []
+        for selector, dep, name in entries(dependencies):
+            # What appending the parsed dep to the tree would have serialized to
+            self.fragments.append(str(doctree.soup(dep, mutable=True)))
+            if selector is None:
+                self.strainers.append(None)
+                continue
+            args, kwargs, *strmatches_ = selector
+            self.strainers.append(bs4.SoupStrainer(*args[:2], **kwargs))
+            names.append(tagNames(args, kwargs))
+        # Dependencies that can be searched for
+        self.searchable = [i for i, strainer in enumerate(self.strainers) if strainer is not None]
+
+        if not names:
+            self.tags = set()
+            self.maybe = None
+        elif all(n is not None for n in names):
+            self.tags = set().union(*names)
+            # A document without any of those tags can't need anything
+            self.maybe = re.compile(
+                f"<(?:{'|'.join(map(re.escape, sorted(self.tags)))})(?=[\\s/>])",
+                re.IGNORECASE
+            )
+        else:
+            self.tags = None
+            self.maybe = None
+
+
+def describe(selector):
+    """A short name for a search pattern, like pre.markdeep"""
+    args, kwargs, *strmatches_ = selector
+    names = tagNames(args, kwargs) or {"*"}
+    class_args = kwargs.get('class_', [])
+    if isinstance(class_args, str):
+        class_args = [class_args]
+    return ",".join(
+        name + "".join(f".{c}" for c in class_args if isinstance(c, str))
+        for name in sorted(names)
+    )
+
+
+class AssetBundle():
+    """
+    Each dependency's markup with its inline scripts and styles moved out to
+    files named by the hash of their contents, so identical blocks are
+    written once and cached by browsers across pages
+    """
+
+    def __init__(self, dependencies, asset_dir):
+        self.asset_dir = asset_dir
+        # filename: text, for every distinct inline block
+        self.assets = {}
+        # Per dependency: the markup to append, its name, its files and its (url, as) preloads
+        self.references = []
+        self.labels = []
+        self.files = []
+        self.preloads = []
+
+        for selector, dep, name in entries(dependencies):
+            label = name or (describe(selector) if selector is not None else f"dependency {len(self.labels)}")
+            if label in self.labels:
+                label = f"{label} ({len(self.labels)})"
+            self.labels.append(label)
+
+            parts = []
+            files = []
+            preloads = []
+            for node in doctree.soup(dep, mutable=True).contents:
+                if isinstance(node, bs4.Tag) and node.name in ("script", "style") and node.string and node.string.strip():
+                    reference = self.externalize(node)
+                    if reference is not None:
+                        node, filename = reference
+                        files.append(filename)
+                if isinstance(node, bs4.Tag):
+                    if node.name == "script" and node.get('src'):
+                        preloads.append((node['src'], "script"))
+                    elif node.name == "link" and "stylesheet" in node.get('rel', []) and node.get('href'):
+                        preloads.append((node['href'], "style"))
+                parts.append(str(node))
+            self.references.append("".join(parts))
+            self.files.append(files)
+            self.preloads.append(preloads)
+
+    def path(self, filename):
+        """Where an asset goes, relative to OUTPUT_PATH"""
+        return posixpath.join(self.asset_dir, filename)
+
+    def externalize(self, node):
+        """
+        A tag referring to `node`'s contents as a file and the file's name,
+        or None to leave it inline
+        """
+        text = node.string
+        if node.name == "script":
+            if node.get('src') or node.get('type', "").strip().lower() not in SCRIPT_TYPES:
+                return None
+            extension = "js"
+        else:
+            extension = "css"
+
+        filename = f"{hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]}.{extension}"
+        self.assets[filename] = text
+        url = STATIC_PREFIX + self.path(filename)
+
+        if node.name == "script":
+            reference = copy.copy(node)
+            reference.clear()
+            reference['src'] = url
+        else:
+            attrs = {k: v for k, v in node.attrs.items() if k != "type"}
+            reference = bs4.BeautifulSoup("", "html.parser").new_tag("link", attrs={'rel': "stylesheet", 'href': url, **attrs})
+        return reference, filename
+
+    def write(self, output_path, filenames):
+        directory = os.path.join(output_path, self.asset_dir)
+        os.makedirs(directory, exist_ok=True)
+        for filename in filenames:
+            with open(os.path.join(directory, filename), "w", encoding="utf-8") as fp:
+                fp.write(self.assets[filename])
+
+
+class StaticAsset():
+    """
+    Stands in for a static file in the build's `static_content`, so Pelican
+    resolves {static} links to an asset like links to any other static file
+    """
+
+    def __init__(self, url):
+        self.url = url
+
+
+def resolve(url, siteurl):
+    """An asset url for a page whose links start with `siteurl`; other urls as they are"""
+    if url.startswith(STATIC_PREFIX):
+        return f"{siteurl}/{url[len(STATIC_PREFIX):]}"
+    return url
+
+
+def manifestPath(settings):
+    """Where the manifest goes, relative to OUTPUT_PATH, or None when off"""
+    manifest = settings.get(MANIFEST_VAR_NAME)
+    if not manifest:
+        return None
+    return manifest if isinstance(manifest, str) else MANIFEST_DEFAULT_PATH
+
+
+def bundle(settings):
+    asset_dir = os.path.dirname(manifestPath(settings))
+    return compiled(AssetBundle, settings.get("RENDER_DEPS", []), asset_dir)
+
+
+# cls: ((repr of RENDER_DEPS, other args), cls(RENDER_DEPS, *other args)).
+# Keyed by repr, since worker processes get an equal but new copy of the
+# settings with every chunk of documents.
+_compiled = {}
+
+
+def compiled(cls, dependencies, *args):
+    key = (repr(dependencies), args)
+    prev_key, matcher = _compiled.get(cls, (None, None))
+    if prev_key != key:
+        matcher = cls(dependencies, *args)
+        _compiled[cls] = (key, matcher)
+    return matcher
+
+
+def tagMatches(strainer, tag):
+    # bs4 4.13 renamed search_tag
+    matches_tag = getattr(strainer, 'matches_tag', None) or strainer.search_tag
+    return bool(matches_tag(tag))
+
+
+class RenderdepsVisitor(pipeline.Visitor):
+    """
+    Appends the configured dependencies to documents that need them
+    """
+    name = "renderdeps"
+    setting_names = ("RENDER_DEPS", "RENDERDEPS_USE_SOUP", MANIFEST_VAR_NAME)
+    metadata_names = (deps.METADATA_KEY,)
+    # Dependencies are appended as strings, not inserted into the tree
+    read_only = True
+
+    def __init__(self):
+        # save_as: indices of the dependencies it got, in manifest mode
+        self.pages = {}
+        self.settings = None
+
+    def begin(self, ctx):
+        settings = ctx.settings
+        dependencies = settings.get("RENDER_DEPS", [])
+        use_soup = settings.get("RENDERDEPS_USE_SOUP", RENDERDEPS_USE_SOUP_DEFAULT)
+
+        # Dependencies the document's producers said it needs don't need finding
+        included = self.declared(ctx, dependencies)
+
+        if use_soup:
+            matcher = compiled(SoupMatcher, dependencies)
+            pending = [i for i in matcher.searchable if i not in included]
+            if pending and not (matcher.maybe and not matcher.maybe.search(ctx.content)):
+                # [matcher, indices of the dependencies still waiting for a match, included]
+                return [matcher, pending, included]
+            result = self.include(ctx, sorted(included), matcher.fragments)
+            return False if result is None else pipeline.Done(result)
+
+        matcher = compiled(DependencyMatcher, dependencies)
+        matched = list(matcher.match(ctx.content, included))
+        for i in matched:
+            if i not in included:
+                ctx.log(logging.DEBUG, f"Matched '{matcher.deps[i][0]}'")
+        result = self.include(ctx, matched, [dep for strmatches, dep in matcher.deps])
+
+        # No need for the tree
+        return False if result is None else pipeline.Done(result)
+
+    def declared(self, ctx, dependencies):
+        names = deps.declared(ctx.metadata)
+        if not names:
+            return set()
+        index = {
+            name: i
+            for i, (selector, dep, name) in enumerate(entries(dependencies))
+            if name is not None
+        }
+        for name in names:
+            if name in index:
+                ctx.log(logging.DEBUG, f"{ctx.source_path} declares {name!r}")
+            else:
+                ctx.log(logging.DEBUG, f"{ctx.source_path} declares {name!r}, which isn't in RENDER_DEPS")
+        return {index[name] for name in names if name in index}
+
+    def visit(self, ctx, state, tag):
+        matcher, pending, included = state
+        for i in pending:
+            if tagMatches(matcher.strainers[i], tag):
+                ctx.log(logging.INFO, "Inserting dependency " + repr(matcher.fragments[i]) + " into " + repr(ctx.source_path) + " matching" + repr(tag))
+                state[1] = [j for j in state[1] if j != i]
+
+    def end(self, ctx, state):
+        matcher, pending, included = state
+        matched = [i for i in range(len(matcher.fragments)) if i in included or (matcher.strainers[i] is not None and i not in pending)]
+        return self.include(ctx, matched, matcher.fragments)
+
+    def include(self, ctx, matched, fragments):
+        """
+        Append the matched dependencies. In manifest mode, that's references
+        to their files, and the indices are returned for `apply`.
+        """
+        if not manifestPath(ctx.settings):
+            for i in matched:
+                ctx.append(fragments[i])
+            return None
+
+        references = bundle(ctx.settings).references
+        for i in matched:
+            ctx.append(references[i])
+        return matched
+
+    def apply(self, instance, generator, matched):
+        if matched is None:
+            return
+        self.settings = instance.settings
+        if not matched:
+            return
+        self.pages[instance.save_as] = matched
+
+        if instance.settings.get(PRELOAD_VAR_NAME):
+            assets = bundle(instance.settings)
+            # These go in the page's own <head>, where Pelican doesn't resolve links
+            if instance.settings.get('RELATIVE_URLS'):
+                siteurl = path_to_url(get_relative_path(instance.save_as))
+            else:
+                siteurl = instance.settings.get('SITEURL') or ""
+            preloads = {}
+            for i in matched:
+                preloads.update(dict.fromkeys(assets.preloads[i]))
+            instance.renderdeps_preload = "".join(
+                f'<link rel="preload" href="{html.escape(resolve(url, siteurl))}" as="{kind}">'
+                for url, kind in preloads
+            )
+
+    def finish(self):
+        if self.settings is None:
+            return
+        settings = self.settings
+        path = manifestPath(settings)
+        assets = bundle(settings)
+
+        used = {i for matched in self.pages.values() for i in matched}
+        filenames = sorted({filename for i in used for filename in assets.files[i]})
+        assets.write(settings['OUTPUT_PATH'], filenames)
+        siteurl = settings.get('SITEURL') or ""
+        manifest = {
+            'dependencies': {
+                label: [resolve(url, siteurl) for url, kind in preloads]
+                for label, preloads in zip(assets.labels, assets.preloads)
+            },
+            'pages': {
+                save_as: [assets.labels[i] for i in matched]
+                for save_as, matched in sorted(self.pages.items())
+            },
+        }
+        with open(os.path.join(settings['OUTPUT_PATH'], path), "w", encoding="utf-8") as fp:
+            json.dump(manifest, fp, indent=1)
+        logging.info(f"Renderdeps: wrote {len(filenames)} assets and the manifest for {len(self.pages)} pages to {path}")
+
+        self.pages = {}
+        self.settings = None
+
+
+def add_static_assets(generator):
+    """
+    Pelican callback
+
+    Adds the asset files to the static files, in manifest mode, so Pelican
+    resolves the {static} links to them.
+    """
+    settings = generator.settings
+    if not manifestPath(settings):
+        return
+    assets = bundle(settings)
+    for filename in assets.assets:
+        path = assets.path(filename)
+        generator.context['static_content'].setdefault(path, StaticAsset(path))
+
+
+def pelican_init(pelican_object):
+    settings = pelican_object.settings
+    visitor.tags = None
+    if settings.get("RENDERDEPS_USE_SOUP", RENDERDEPS_USE_SOUP_DEFAULT):
+        # Only visit the tags some dependency is looking for
+        visitor.tags = compiled(SoupMatcher, settings.get("RENDER_DEPS", [])).tags
 
-    if THREADED:
-        for _ in range(MAX_THREADS):
-            Worker(process_dependencies).start()
-        q.join()  # blocks until the queue is empty.
 
+visitor = RenderdepsVisitor()
 
 
 def register():
-    signals.all_generators_finalized.connect(add_deps)
+    gio_common.register()
+    signals.initialized.connect(pelican_init)
+    signals.static_generator_finalized.connect(add_static_assets)
+    pipeline.register_visitor(visitor)
+    deps.signal.connect(deps.receive)
@@ -4,10 +4,13 @@ Better tipue search
 
 """
 
+import collections
+import hashlib
+import logging
 import os.path
 import re
 import json
-from bs4 import BeautifulSoup
+import sys
 from codecs import open
 
 try:
@@ -18,6 +21,36 @@ except ImportError:
 from pelican import signals
 from pelican.generators import CachingGenerator
 
+try:
+    import gio_common
+except ImportError:
+    # PLUGIN_PATHS isn't on sys.path, so find gio_common next to this plugin
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    import gio_common
+from gio_common import cache, doctree
+
+logger = logging.getLogger(__name__)
+
+# Bump when the way page text is extracted changes
+CACHE_VERSION = 1
+
+# Write the index as a manifest and shards instead of one file: by
+# 'category', by 'date' range, or by term 'prefix'
+SHARDS_VAR_NAME = 'SEX_VAMPIRES_SHARDS'
+SHARD_MODES = ('category', 'date', 'prefix')
+# Shards are cut at about this many bytes, where they can be
+SHARD_SIZE_VAR_NAME = 'SEX_VAMPIRES_SHARD_SIZE'
+DEFAULT_SHARD_SIZE = 256 * 1024
+
+SHARD_DIR = 'tipuesearch'
+MANIFEST_NAME = 'manifest.json'
+SHARD_NAME_RE = re.compile(r'^[0-9a-f]{16}\.json$')
+
+# Prefix buckets bigger than the shard size are split by their next
+# character, up to prefixes this long
+MAX_PREFIX = 3
+TERM_RE = re.compile(r'\w+')
+
 def unTypography(string):
     ret = string
     # Uncaught whitespace
@@ -51,6 +84,15 @@ class TipuesearchContentGenerator(CachingGenerator):
         self.tpages = settings.get('TEMPLATE_PAGES')
         self.output_path = output_path
         self.json_nodes = []
+        # Dates of the nodes that have them, by node id
+        self.node_dates = {}
+
+        self.shard_mode = settings.get(SHARDS_VAR_NAME)
+        self.shard_size = settings.get(SHARD_SIZE_VAR_NAME, DEFAULT_SHARD_SIZE)
+        # Names of the shard files written this build, so stale ones can be removed
+        self.written = set()
+
+        self.text_cache = cache.get_cache("sex_vampires", CACHE_VERSION, settings)
 
     def generate_output(self, writer):
         # The primary function that gets called. 
@@ -73,7 +115,17 @@ class TipuesearchContentGenerator(CachingGenerator):
 
         # Process non-template pages
         for page in pages:
-            self.json_nodes.append(self.nodeFromPage(page))
+            node = self.nodeFromPage(page)
+            self.json_nodes.append(node)
+            if node is not None and getattr(page, 'date', None) is not None:
+                self.node_dates[id(node)] = page.date
+
+        if self.shard_mode:
+            if self.shard_mode not in SHARD_MODES:
+                logger.warning(f"{SHARDS_VAR_NAME} is {self.shard_mode!r}, not one of {SHARD_MODES}; writing one file")
+            else:
+                self.writeShards([node for node in self.json_nodes if node is not None])
+                return
 
         # Make variable object
         data = json.dumps({'pages': self.json_nodes}, separators=(',', ':'), ensure_ascii=False, indent=1)
@@ -90,11 +142,13 @@ class TipuesearchContentGenerator(CachingGenerator):
         if getattr(page, 'status', 'published') != 'published':
             return
 
-        soup_title = BeautifulSoup(page.title, 'html.parser')
+        soup_title = doctree.soup(page.title)
         page_title = unTypography(soup_title.get_text(' ', strip=True))
 
-        soup_text = BeautifulSoup(page._content, 'html.parser')
-        page_text = unTypography(soup_text.get_text(' ', strip=True))
+        page_text = self.text_cache.fetch(
+            lambda: unTypography(doctree.text(page._content)),
+            page._content
+        )
         # page_text = ' '.join(page_text.split())
 
         page_category = page.category.name if getattr(page, 'category', 'None') != 'None' else ''
@@ -113,11 +167,138 @@ class TipuesearchContentGenerator(CachingGenerator):
 
         return node
 
+    def writeShards(self, nodes):
+        shard_dir = os.path.join(self.output_path, SHARD_DIR)
+        os.makedirs(shard_dir, exist_ok=True)
+
+        if self.shard_mode == 'prefix':
+            manifest = self.prefixShards(nodes)
+        elif self.shard_mode == 'category':
+            manifest = self.categoryShards(nodes)
+        else:
+            manifest = self.dateShards(nodes)
+        manifest = {'mode': self.shard_mode, **manifest}
+
+        with open(os.path.join(shard_dir, MANIFEST_NAME), 'w', encoding='utf-8') as fd:
+            json.dump(manifest, fd, separators=(',', ':'), ensure_ascii=False)
+
+        # Shards of earlier builds
+        for name in os.listdir(shard_dir):
+            if SHARD_NAME_RE.match(name) and name not in self.written:
+                os.remove(os.path.join(shard_dir, name))
+
+        logger.info(f"Sex vampires: {len(nodes)} pages in {len(self.written)} {self.shard_mode} shards")
+
+    def writeShard(self, data):
+        """Write one shard, named for its contents, and return its name"""
+        text = json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+        name = hashlib.sha256(text.encode('utf-8')).hexdigest()[:16] + '.json'
+        if name not in self.written:
+            with open(os.path.join(self.output_path, SHARD_DIR, name), 'w', encoding='utf-8') as fd:
+                fd.write(text)
+            self.written.add(name)
+        return name
+
+    def chunks(self, items, size_of):
+        """Split `items` in order into runs of about shard_size bytes"""
+        chunk, size = [], 0
+        for item in items:
+            item_size = size_of(item)
+            if chunk and size + item_size > self.shard_size:
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(item)
+            size += item_size
+        if chunk:
+            yield chunk
+
+    @staticmethod
+    def nodeSize(node):
+        return len(json.dumps(node, separators=(',', ':'), ensure_ascii=False).encode('utf-8'))
+
+    def categoryShards(self, nodes):
+        by_category = collections.defaultdict(list)
+        for node in nodes:
+            by_category[node['tags']].append(node)
+
+        shards = []
+        for category, category_nodes in by_category.items():
+            for chunk in self.chunks(category_nodes, self.nodeSize):
+                shards.append({'file': self.writeShard({'pages': chunk}), 'category': category, 'pages': len(chunk)})
+        return {'shards': shards}
+
+    def dateShards(self, nodes):
+        # Newest first, and pages with no date after everything else
+        dated = sorted(
+            (node for node in nodes if id(node) in self.node_dates),
+            key=lambda node: self.node_dates[id(node)], reverse=True
+        )
+        undated = [node for node in nodes if id(node) not in self.node_dates]
+
+        shards = []
+        for chunk in self.chunks(dated, self.nodeSize):
+            dates = [self.node_dates[id(node)] for node in chunk]
+            shards.append({
+                'file': self.writeShard({'pages': chunk}),
+                'from': min(dates).date().isoformat(),
+                'to': max(dates).date().isoformat(),
+                'pages': len(chunk),
+            })
+        for chunk in self.chunks(undated, self.nodeSize):
+            shards.append({'file': self.writeShard({'pages': chunk}), 'from': None, 'to': None, 'pages': len(chunk)})
+        return {'shards': shards}
+
+    def prefixShards(self, nodes):
+        """
+        A list of pages without their text, and an index of which pages
+        each term is in, in shards by the terms' first characters
+        """
+        pages = [{key: node[key] for key in ('title', 'tags', 'url', 'loc') if key in node} for node in nodes]
+
+        postings = collections.defaultdict(list)
+        for i, node in enumerate(nodes):
+            for term in sorted(set(TERM_RE.findall(f"{node['title']} {node['text']}".lower()))):
+                postings[term].append(i)
+
+        # Bytes of each term's entry, as "term":[1,2],
+        sizes = {
+            term: len(term.encode('utf-8')) + 4 + len(",".join(map(str, pages_in)))
+            for term, pages_in in postings.items()
+        }
+        term_size = sizes.__getitem__
+
+        # Buckets of terms by prefix, in prefix order
+        def buckets(terms, prefix):
+            if prefix and (sum(map(term_size, terms)) <= self.shard_size or len(prefix) >= MAX_PREFIX):
+                yield prefix, terms
+                return
+            by_next = collections.defaultdict(list)
+            here = []
+            for term in terms:
+                if len(term) > len(prefix):
+                    by_next[term[:len(prefix) + 1]].append(term)
+                else:
+                    here.append(term)
+            if here:
+                yield prefix, here
+            for next_prefix in sorted(by_next):
+                yield from buckets(by_next[next_prefix], next_prefix)
+
+        # Small neighboring buckets share a shard
+        prefixes = {}
+        all_buckets = buckets(sorted(postings), "")
+        for chunk in self.chunks(all_buckets, lambda bucket: sum(map(term_size, bucket[1]))):
+            name = self.writeShard({term: postings[term] for _, terms in chunk for term in terms})
+            for prefix, _ in chunk:
+                prefixes[prefix] = name
+
+        return {'pages': self.writeShard({'pages': pages}), 'prefixes': prefixes}
+
     def nodeFromRawPage(self, srclink):
         # Takes a url to a template page and creates a search node
 
         srcfile = open(os.path.join(self.output_path, srclink), encoding='utf-8')
-        soup = BeautifulSoup(srcfile, 'html.parser')
+        soup = doctree.soup(srcfile)
 
         # Only printable characters
         while True:
@@ -147,4 +328,5 @@ def get_generators(generators):
     return TipuesearchContentGenerator
 
 def register():
+    gio_common.register()
     signals.get_generators.connect(get_generators)
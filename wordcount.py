@@ -1,9 +1,24 @@
+import array
+import html.parser
 import logging
 from pelican import signals
-import bs4
-import nltk.tokenize
 import collections
+import collections.abc
+import functools
 import re
+import os.path
+import sys
+
+# Imported by loadNumpy, only for batch mode and related articles
+numpy = None
+
+try:
+    import gio_common
+except ImportError:
+    # PLUGIN_PATHS isn't on sys.path, so find gio_common next to this plugin
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    import gio_common
+from gio_common import cache
 
 logger = logging.getLogger(__name__)
 
@@ -12,12 +27,39 @@ WPM = DEFAULT_WPM
 
 INCL_BLOCKQUOTES = False
 
+# Keep only this many of each article's most common words, or all of them
+TOP_WORDS_VAR_NAME = 'WORDCOUNT_TOP_WORDS'
+
+# Bump when the contents of stats change
+CACHE_VERSION = 4
+
+# Compute the stats of all content at once, as soon as it's all read
+BATCH_VAR_NAME = 'WORDCOUNT_BATCH'
+
+# How many related articles to find for each article, if any
+RELATED_VAR_NAME = 'WORDCOUNT_RELATED'
+# Words in more than this share of articles say nothing about which are related
+RELATED_MAX_DF = 0.5
+# Past this share of articles added, changed or removed, word weights are refit
+RELATED_REFIT = 0.2
+# Most products of term weights one block of articles is scored with at once
+RELATED_BLOCK = 1 << 22
+
+# Settings the cached stats depend on
+STATS_SETTING_NAMES = ('WORDCOUNT_WPM', TOP_WORDS_VAR_NAME)
+
 TextStats = collections.namedtuple("TextStats", ['stcs', 'words', 'syllables'])
 
-# Todo: This needs functionality for filtering out blockquotes.
+def loadNumpy():
+    """Import numpy the first time it's needed, returning whether it's installed"""
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            return False
+    return True
 
-only_blockquotes = bs4.SoupStrainer(name='blockquote')
-no_blockquotes = bs4.SoupStrainer(lambda n, a: n != 'blockquote')
 
 def pelican_init(pelican_object):
     global WPM
@@ -25,34 +67,194 @@ def pelican_init(pelican_object):
         logger.warning("No 'WORDCOUNT_WPM' given, using default value %s", DEFAULT_WPM)
     WPM = pelican_object.settings.get('WORDCOUNT_WPM', DEFAULT_WPM)
 
+# Word counting tables, built once
+ENTITY_RE = re.compile(r'\&\#?.+?;')
+# Punctuation is dropped, not split on, so "don't" is one word
+DROP_TABLE = str.maketrans('', '', r'.,?!@#$%^&*()_+-=\|/[]{}`~:;\'\"‘’—…“”')
+WORD_RE = re.compile(r'\w+')
+
+
 def getWordCounter(raw_text):
     # Process the text to remove entities
-    entities = r'\&\#?.+?;'
-    raw_text = re.sub(entities, '', raw_text.replace('&nbsp;', ' '))
+    raw_text = ENTITY_RE.sub('', raw_text.replace('&nbsp;', ' '))
+
+    # Process the text to remove punctuation, and count words
+    return collections.Counter(WORD_RE.findall(raw_text.translate(DROP_TABLE)))
+
+class Vocabulary():
+    """Every word seen this build, each stored once and numbered"""
+
+    def __init__(self):
+        self.terms = []
+        self.ids = {}
+
+    def intern(self, term):
+        term_id = self.ids.get(term)
+        if term_id is None:
+            term_id = self.ids[term] = len(self.terms)
+            self.terms.append(term)
+        return term_id
+
+
+VOCABULARY = Vocabulary()
+
+
+class WordCounts(collections.abc.Mapping):
+    """
+    An article's word frequencies, as arrays of ids into the site-wide
+    vocabulary and their counts, in the order the words first appear.
+    Reads like a collections.Counter: missing words count 0.
+    """
+    __slots__ = ('ids', 'counts', '_positions')
+
+    def __init__(self, pairs=()):
+        self.ids = array.array('I')
+        self.counts = array.array('I')
+        self._positions = None
+        intern = VOCABULARY.intern
+        for term, count in pairs:
+            self.ids.append(intern(term))
+            self.counts.append(count)
+
+    @classmethod
+    def fromCounter(cls, counter, top=None):
+        return cls(counter.most_common(top) if top else counter.items())
+
+    def _position(self, term):
+        term_id = VOCABULARY.ids.get(term)
+        if term_id is None:
+            return None
+        if self._positions is None:
+            # Only articles that get looked up pay for the index
+            self._positions = {term_id: i for i, term_id in enumerate(self.ids)}
+        return self._positions.get(term_id)
+
+    def __getitem__(self, term):
+        i = self._position(term)
+        return 0 if i is None else self.counts[i]
+
+    def __contains__(self, term):
+        return self._position(term) is not None
+
+    def get(self, term, default=None):
+        i = self._position(term)
+        return default if i is None else self.counts[i]
+
+    def __iter__(self):
+        terms = VOCABULARY.terms
+        return (terms[term_id] for term_id in self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return list(self.counts)
+
+    def items(self):
+        return list(zip(self, self.counts))
 
-    # Process the text to remove punctuation
-    drop = r'.,?!@#$%^&*()_+-=\|/[]{}`~:;\'\"‘’—…“”'
-    cleaned_text = raw_text.translate(dict((ord(c), u'') for c in drop))
+    def most_common(self, n=None):
+        ranked = sorted(self.items(), key=lambda item: item[1], reverse=True)
+        return ranked if n is None else ranked[:n]
+
+    def total(self):
+        return sum(self.counts)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self.items())!r})"
+
+    def __reduce__(self):
+        # Ids only mean something in this build, so store the words
+        return (type(self), (self.items(),))
 
-    # Word counter, count
-    words = nltk.tokenize.RegexpTokenizer(r'\w+').tokenize(cleaned_text)
-    return collections.Counter(words)
 
 def roundCounterToCount(counter):
     count = sum(counter.values())
     count = int(round(count, -1))
     return count
 
-def getRawText(instance):
-    soup = bs4.BeautifulSoup(instance._content, 'html.parser')
-    bq_text = []
-    for bq in soup.find_all("blockquote"):
-        if not bq.find("blockquote"):
-            # Must not be a root with nested blockquotes inside
-            bq_text.append(bq.getText())
-            bq.extract()
-
-    return " ".join(bq_text), soup.getText()
+class TextSplitter(html.parser.HTMLParser):
+    """
+    Splits a document's text into the text of its innermost blockquotes and
+    everything else, in one pass over the markup, without building a tree.
+    Text and nesting are as BeautifulSoup's html.parser tree would have them:
+    no comments, scripts, styles or templates, and an end tag closes every
+    element opened since its start tag.
+    """
+    # Tags whose contents aren't text
+    SKIP_TAGS = ('script', 'style', 'template')
+    # Tags that are never open, as in bs4
+    VOID_TAGS = frozenset((
+        'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'menuitem',
+        'meta', 'param', 'source', 'track', 'wbr', 'basefont', 'bgsound', 'command', 'frame',
+        'image', 'isindex', 'nextid', 'spacer',
+    ))
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.bq_text = []
+        self.nbq_text = []
+        self.open_tags = []
+        # One per open blockquote: its text so far, until a blockquote opens
+        # inside it and it's no longer innermost, then None
+        self.open_bqs = []
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.VOID_TAGS:
+            return
+        self.open_tags.append(tag)
+        if tag in self.SKIP_TAGS:
+            self.skip_depth += 1
+        elif tag == "blockquote":
+            if self.open_bqs and self.open_bqs[-1] is not None:
+                # Not innermost after all; what it had so far is body text
+                self.nbq_text.extend(self.open_bqs[-1])
+                self.open_bqs[-1] = None
+            self.open_bqs.append([])
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        # Stray end tags are ignored
+        if tag in self.open_tags:
+            while self.pop_tag() != tag:
+                pass
+
+    def pop_tag(self):
+        tag = self.open_tags.pop()
+        if tag in self.SKIP_TAGS:
+            self.skip_depth -= 1
+        elif tag == "blockquote":
+            text = self.open_bqs.pop()
+            if text is not None:
+                self.bq_text.append("".join(text))
+        return tag
+
+    def handle_data(self, data):
+        if self.skip_depth:
+            return
+        if self.open_bqs and self.open_bqs[-1] is not None:
+            self.open_bqs[-1].append(data)
+        else:
+            self.nbq_text.append(data)
+
+    def split(self, content):
+        self.feed(content)
+        self.close()
+        # Unclosed elements end with the document
+        while self.open_tags:
+            self.pop_tag()
+        return " ".join(self.bq_text), "".join(self.nbq_text)
+
+
+def getRawText(content):
+    return TextSplitter().split(content)
 
 def content_object_init(instance):
     """
@@ -61,78 +263,502 @@ def content_object_init(instance):
     if instance._content is None:
         return
 
-    bq_text, nbq_text = getRawText(instance)
+    # Stats are of the content as read, before other plugins add to it
+    instance.stats = LazyStats(instance._content, instance.settings)
 
-    stats = {}
 
-    # Use BeautifulSoup to get readable/visible text
-    # raw_text = bs4.BeautifulSoup(instance._content, 'html.parser').getText()
+def getCounts(bq_text, nbq_text):
+    stats = {}
 
     # Calculate basic word stats
     stats['word_count_wpm'] = WPM
 
-    word_counts_bq = getWordCounter(bq_text)
-    # stats['bq_text'] = bq_text
-    stats['wc_bq'] = roundCounterToCount(word_counts_bq)
+    stats['wc_bq'] = roundCounterToCount(getWordCounter(bq_text))
     stats['read_mins_bq'] = stats['wc_bq'] // WPM
 
-    word_counts_nbq = getWordCounter(nbq_text)
-    # stats['nbq_text'] = nbq_text
-    stats['wc_nbq'] = roundCounterToCount(word_counts_nbq)
+    stats['wc_nbq'] = roundCounterToCount(getWordCounter(nbq_text))
     stats['read_mins_nbq'] = stats['wc_nbq'] // WPM
 
     stats['wc'] = stats['wc_bq'] + stats['wc_nbq']
     stats['read_mins'] = stats['read_mins_bq'] + stats['read_mins_nbq']
 
-    stats['word_counts_nbq'] = word_counts_nbq
+    return stats
 
+
+def getWordCounts(bq_text, nbq_text, top=None):
+    return {'word_counts_nbq': WordCounts.fromCounter(getWordCounter(nbq_text), top)}
+
+
+def getReadability(bq_text, nbq_text, wc):
     # Calculate Flesch-kincaid readbility stats
     # Stats don't care about sentence order so we can just concat the chunks together
-    readability_stats = text_stats(bq_text + nbq_text, stats['wc'])
-    stats['fi'] = f"{flesch_index(readability_stats):.2f}"
-    stats['fk'] = f"{flesch_kincaid_level(readability_stats):.2f}"
+    return scoreStats(text_stats(bq_text + nbq_text, wc))
+
+
+# The stats computed together, in the order they're listed
+STAT_GROUPS = {
+    'counts': ('word_count_wpm', 'wc_bq', 'read_mins_bq', 'wc_nbq', 'read_mins_nbq', 'wc', 'read_mins'),
+    'word_counts': ('word_counts_nbq',),
+    'readability': ('fi', 'fk'),
+}
+STAT_GROUP_OF = {key: group for group, keys in STAT_GROUPS.items() for key in keys}
+
+
+class LazyStats(collections.abc.Mapping):
+    """
+    An article's stats. Each group of them is computed (or fetched from the
+    cache) the first time one of them is read, so content whose stats are
+    never read costs nothing.
+    """
+
+    def __init__(self, content, settings):
+        self._content = content
+        self._settings = settings
+        self._stats = {}
+
+    def __getitem__(self, key):
+        if key not in self._stats:
+            group = STAT_GROUP_OF[key]
+            self._stats.update(self._cache().fetch(lambda: self._compute(group), self._content, group))
+        return self._stats[key]
+
+    def _cache(self):
+        return cache.get_cache("wordcount", CACHE_VERSION, self._settings, STATS_SETTING_NAMES)
+
+    def _compute(self, group, raw_text=None):
+        bq_text, nbq_text = raw_text or getRawText(self._content)
+        if group == 'counts':
+            return getCounts(bq_text, nbq_text)
+        if group == 'word_counts':
+            return getWordCounts(bq_text, nbq_text, self._settings.get(TOP_WORDS_VAR_NAME))
+        return getReadability(bq_text, nbq_text, self['wc'])
+
+    def __iter__(self):
+        return iter(STAT_GROUP_OF)
+
+    def __len__(self):
+        return len(STAT_GROUP_OF)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+# Word count and read time of a number of articles
+WordTotals = collections.namedtuple("WordTotals", ['articles', 'wc', 'read_mins'])
+NO_WORDS = WordTotals(0, 0, 0)
+
+TOTAL_KINDS = ('categories', 'tags', 'authors')
+
+
+def articleObjects(article, kind):
+    """The article's category, tags or authors"""
+    if kind == 'categories':
+        return [article.category]
+    return getattr(article, kind, None) or []
 
-    instance.stats = stats
+
+def articleGroups(article):
+    """The names of the category, tags and authors an article counts towards"""
+    return tuple(
+        tuple(str(obj) for obj in articleObjects(article, kind))
+        for kind in TOTAL_KINDS
+    )
+
+
+def sumArticles(articles, settings):
+    """
+    Total the articles' word counts and read times, for the site and by
+    category, tag and author.
+
+    The totals and what each article added to them are kept in the cache, so
+    the next build only adds and takes away the articles that were added,
+    edited, moved or removed since.
+    """
+    stats_cache = cache.get_cache("wordcount", CACHE_VERSION, settings, STATS_SETTING_NAMES)
+    state = stats_cache.get_state("totals") or {
+        'articles': {}, 'site': NO_WORDS, **{kind: {} for kind in TOTAL_KINDS}
+    }
+    previous = state['articles']
+    current = {}
+
+    def add(record, sign):
+        _, groups, totals = record
+        state['site'] = WordTotals(*(a + sign * b for a, b in zip(state['site'], totals)))
+        for kind, names in zip(TOTAL_KINDS, groups):
+            by_name = state[kind]
+            for name in names:
+                summed = WordTotals(*(a + sign * b for a, b in zip(by_name.get(name, NO_WORDS), totals)))
+                if summed.articles:
+                    by_name[name] = summed
+                else:
+                    by_name.pop(name, None)
+
+    changed = 0
+    for article in articles:
+        if getattr(article, 'stats', None) is None:
+            continue
+        digest = cache.content_hash(article._content)
+        groups = articleGroups(article)
+        record = previous.pop(article.source_path, None)
+        if record is None or record[:2] != (digest, groups):
+            if record is not None:
+                add(record, -1)
+            record = (digest, groups, WordTotals(1, article.stats['wc'], article.stats['read_mins']))
+            add(record, 1)
+            changed += 1
+        current[article.source_path] = record
+
+    # Articles that are gone
+    for record in previous.values():
+        add(record, -1)
+    changed += len(previous)
+
+    state['articles'] = current
+    if changed:
+        stats_cache.set_state("totals", state)
+    logger.debug(f"Wordcount totals: {changed} of {len(current)} articles changed")
+    return state
+
+
+class SiteStats():
+    """
+    Word counts and read times summed over all articles (`site`), and over
+    each category, tag and author's articles (`categories`, `tags` and
+    `authors`, keyed like the generator's). Summed the first time any of them
+    is read.
+    """
+
+    def __init__(self, articles, settings):
+        self._articles = articles
+        self._settings = settings
+        self._totals = None
+
+    def _get(self, kind):
+        if self._totals is None:
+            state = sumArticles(self._articles, self._settings)
+            self._totals = {'site': state['site']}
+            for kind_name in TOTAL_KINDS:
+                by_name = state[kind_name]
+                self._totals[kind_name] = {
+                    obj: by_name.get(str(obj), NO_WORDS)
+                    for article in self._articles
+                    for obj in articleObjects(article, kind_name)
+                }
+        return self._totals[kind]
+
+    site = property(lambda self: self._get('site'))
+    categories = property(lambda self: self._get('categories'))
+    tags = property(lambda self: self._get('tags'))
+    authors = property(lambda self: self._get('authors'))
+
+
+def fillStats(all_stats):
+    """
+    Compute every stat of every LazyStats in `all_stats` that isn't cached
+    yet, reading each one's text once and scoring the readability of all of
+    them in one batch.
+    """
+    pending = []
+    for stats in all_stats:
+        stats_cache = stats._cache()
+        raw_text = None
+        for group, keys in STAT_GROUPS.items():
+            if keys[0] in stats._stats:
+                continue
+            cached = stats_cache.get(stats._content, group)
+            if cached is not None:
+                stats._stats.update(cached)
+                continue
+            if raw_text is None:
+                raw_text = getRawText(stats._content)
+            if group == 'readability':
+                pending.append((stats, raw_text))
+            else:
+                stats._stats.update(stats._compute(group, raw_text))
+                stats_cache.set(stats._content, {key: stats._stats[key] for key in keys}, group)
+
+    scores = batchReadability(
+        [bq_text + nbq_text for _, (bq_text, nbq_text) in pending],
+        [stats['wc'] for stats, _ in pending]
+    )
+    for (stats, _), readability in zip(pending, scores):
+        stats._stats.update(readability)
+        stats._cache().set(stats._content, readability, 'readability')
+    if pending:
+        logger.debug(f"Wordcount: scored {len(pending)} documents in one batch")
+
+
+# Where the article and page generators keep their content
+CONTENT_LISTS = (
+    'articles', 'translations', 'drafts', 'drafts_translations', 'hidden_articles',
+    'hidden_translations', 'pages', 'hidden_pages', 'draft_pages', 'draft_translations',
+)
+
+
+def fill_generator_stats(generator):
+    """
+    Pelican callback
+    """
+    if not generator.settings.get(BATCH_VAR_NAME):
+        return
+    fillStats(
+        content.stats
+        for name in CONTENT_LISTS
+        for content in getattr(generator, name, [])
+        if getattr(content, 'stats', None) is not None
+    )
+
+
+def ranges(starts, lengths):
+    """The indices start, ..., start + length - 1 of each pair, concatenated"""
+    offsets = numpy.repeat(starts + lengths - numpy.cumsum(lengths), lengths)
+    return offsets + numpy.arange(lengths.sum())
+
+
+def fitIdf(word_counts):
+    """
+    Inverse document frequencies of the words in `word_counts`, by word, as
+    smoothed log((1 + n) / (1 + df)) + 1, and 0 for words too common to tell
+    articles apart
+    """
+    n = len(word_counts)
+    ids = numpy.concatenate([numpy.asarray(counts.ids, dtype=numpy.int64) for counts in word_counts])
+    df = numpy.bincount(ids, minlength=len(VOCABULARY.terms))
+    idf = numpy.log((1 + n) / (1 + df)) + 1
+    idf[df > max(RELATED_MAX_DF * n, 2)] = 0
+    terms = VOCABULARY.terms
+    return {terms[term_id]: weight for term_id, weight in zip(numpy.flatnonzero(df).tolist(), idf[df > 0].tolist())}
+
+
+class TermMatrix():
+    """
+    Articles' TF-IDF vectors, L2-normalized, as sparse rows (the terms of
+    each article) and columns (the articles of each term) in numpy arrays,
+    indexed by VOCABULARY id.
+    """
+
+    def __init__(self, word_counts, idf, fit_docs):
+        self.n = n = len(word_counts)
+        # Words the weights were fit without are as rare as can be
+        unseen = numpy.log((1 + fit_docs) / 2) + 1
+        weights = numpy.array([idf.get(term, unseen) for term in VOCABULARY.terms])
+
+        ids = [numpy.asarray(counts.ids, dtype=numpy.int64) for counts in word_counts]
+        indices = numpy.concatenate(ids)
+        rows = numpy.repeat(numpy.arange(n), [len(i) for i in ids])
+        data = numpy.concatenate([numpy.asarray(counts.counts, dtype=float) for counts in word_counts])
+        data *= weights[indices]
+        keep = data > 0
+        indices, rows, data = indices[keep], rows[keep], data[keep]
+        norms = numpy.sqrt(numpy.bincount(rows, weights=data * data, minlength=n))
+        data /= norms[rows]
+
+        self.indices, self.data = indices, data
+        self.indptr = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(rows, minlength=n))))
+
+        order = numpy.argsort(indices, kind='stable')
+        self.post_rows, self.post_data = rows[order], data[order]
+        self.df = numpy.bincount(indices, minlength=len(weights))
+        self.post_ptr = numpy.concatenate(([0], numpy.cumsum(self.df)))
+        # How many products scoring each row takes
+        self.row_cost = numpy.bincount(rows, weights=self.df[indices], minlength=n)
+
+    def products(self, block):
+        """The dot products of the rows in `block` with every row, densely"""
+        starts = self.indptr[block]
+        entries = ranges(starts, self.indptr[block + 1] - starts)
+        local = numpy.repeat(numpy.arange(len(block)), self.indptr[block + 1] - starts)
+        terms = self.indices[entries]
+        df = self.df[terms]
+        postings = ranges(self.post_ptr[terms], df)
+        keys = numpy.repeat(local, df) * self.n + self.post_rows[postings]
+        values = numpy.repeat(self.data[entries], df) * self.post_data[postings]
+        return numpy.bincount(keys, weights=values, minlength=len(block) * self.n).reshape(len(block), self.n)
+
+    def blocks(self, rows):
+        """Split `rows` into blocks of about RELATED_BLOCK products each"""
+        block, cost = [], 0
+        for row in rows:
+            cost += self.row_cost[row] + self.n
+            block.append(row)
+            if cost >= RELATED_BLOCK:
+                yield numpy.array(block)
+                block, cost = [], 0
+        if block:
+            yield numpy.array(block)
+
+
+def nearest(matrix, rows, k):
+    """
+    For each of `rows`, its scores against every row, and the k other rows
+    with the highest scores above 0, best first
+    """
+    k = min(k, matrix.n - 1)
+    for block in matrix.blocks(rows):
+        scores = matrix.products(block)
+        scores[numpy.arange(len(block)), block] = 0
+        if k <= 0:
+            top = numpy.zeros((len(block), 0), dtype=numpy.int64)
+        else:
+            top = numpy.argpartition(-scores, k - 1, axis=1)[:, :k]
+        for i, row in enumerate(block.tolist()):
+            candidates = top[i][scores[i, top[i]] > 0]
+            candidates = candidates[numpy.lexsort((candidates, -scores[i, candidates]))]
+            yield row, scores[i], [(int(c), float(scores[i, c])) for c in candidates]
+
+
+def relatedArticles(articles, settings, k):
+    """
+    The k most similar articles to each of `articles`, by the cosine of
+    their TF-IDF vectors, as lists of (source_path, score) by source_path.
+
+    The lists and the word weights are kept in the cache. The next build
+    scores only the articles that changed against all of them, and merges
+    those scores into the lists of the others, keeping the weights it had.
+    Only articles whose lists had a changed or removed article in them are
+    scored again in full. Once enough of the site has changed, the weights
+    are fit again, and everything is scored.
+    """
+    if not articles:
+        return {}
+    stats_cache = cache.get_cache("wordcount", CACHE_VERSION, settings, STATS_SETTING_NAMES)
+    articles = sorted(articles, key=lambda article: article.source_path)
+    paths = [article.source_path for article in articles]
+    digests = [cache.content_hash(article._content) for article in articles]
+
+    state = stats_cache.get_state("related")
+    if state is not None and state['k'] != k:
+        state = None
+    stored = state['articles'] if state else {}
+
+    changed = {path for path, digest in zip(paths, digests) if stored.get(path, (None,))[0] != digest}
+    removed = stored.keys() - set(paths)
+    if state is not None and not changed and not removed:
+        return {path: stored[path][1] for path in paths}
+
+    word_counts = [article.stats['word_counts_nbq'] for article in articles]
+    refit = state is None or len(changed) + len(removed) > RELATED_REFIT * len(paths)
+    if refit:
+        state = {'k': k, 'idf': fitIdf(word_counts), 'docs': len(paths)}
+        rows = range(len(paths))
+    else:
+        gone = changed | removed
+        rows = [
+            i for i, path in enumerate(paths)
+            if path in changed or any(other in gone for other, _ in stored[path][1])
+        ]
+    matrix = TermMatrix(word_counts, state['idf'], state['docs'])
+
+    related = {}
+    # Scores of changed articles against the ones not scored again
+    candidates = collections.defaultdict(list)
+    for row, scores, top in nearest(matrix, rows, k):
+        related[paths[row]] = [(paths[other], score) for other, score in top]
+        if not refit and paths[row] in changed:
+            for other in numpy.flatnonzero(scores > 0).tolist():
+                candidates[other].append((paths[row], float(scores[other])))
+
+    for i, path in enumerate(paths):
+        if path not in related:
+            merged = stored[path][1] + candidates.get(i, [])
+            related[path] = sorted(merged, key=lambda pair: (-pair[1], pair[0]))[:k]
+
+    state['articles'] = {path: (digest, related[path]) for path, digest in zip(paths, digests)}
+    stats_cache.set_state("related", state)
+    logger.debug(f"Wordcount related: scored {len(rows)} of {len(paths)} articles{' after refitting' if refit else ''}")
+    return related
+
+
+def set_related_articles(generator):
+    k = generator.settings.get(RELATED_VAR_NAME)
+    if not k:
+        return
+    if not loadNumpy():
+        logger.warning(f"{RELATED_VAR_NAME} is set, but numpy isn't installed")
+        return
+    by_path = {article.source_path: article for article in generator.articles}
+    articles = [article for article in generator.articles if getattr(article, 'stats', None) is not None]
+    related = relatedArticles(articles, generator.settings, k)
+    for article in generator.articles:
+        article.related_articles = [by_path[path] for path, _ in related.get(article.source_path, [])]
+
+
+def article_generator_finalized(generator):
+    """
+    Pelican callback
+    """
+    fill_generator_stats(generator)
+    set_related_articles(generator)
+    generator.context['word_stats'] = SiteStats(generator.articles, generator.settings)
+
+
+def finalized(pelican_object):
+    """
+    Pelican callback
+
+    Word ids only mean something for one build, so the next one (under
+    --autoreload) starts with an empty vocabulary. Cached word counts are
+    dropped from memory with it, and interned again when they're read back.
+    """
+    global VOCABULARY
+    cache.get_cache("wordcount", CACHE_VERSION, pelican_object.settings, STATS_SETTING_NAMES).release()
+    VOCABULARY = Vocabulary()
 
 
 def register():
     """
     Part of Pelican API
     """
+    gio_common.register()
     signals.initialized.connect(pelican_init)
     signals.content_object_init.connect(content_object_init)
+    signals.article_generator_finalized.connect(article_generator_finalized)
+    signals.page_generator_finalized.connect(fill_generator_stats)
+    signals.finalized.connect(finalized)
 
 
 # All below: readability
 
+TERMINATORS = re.escape(".!?:;")
+NON_TEXT_RE = re.compile(r"[^%s\sA-Za-z]+" % TERMINATORS)
+# Same as \s*([terminators]+\s*)+, without the nested repeat
+TERMINATOR_RE = re.compile(r"\s*[%s][%s\s]*" % (TERMINATORS, TERMINATORS))
+SUFFIX_RE = re.compile(r"(es|ed|(?<!l)e)$")
+VOWELS_RE = re.compile(r"[aeiouy]+")
+
+
+# The same few thousand words come up over and over
+@functools.lru_cache(maxsize=1 << 16)
 def countSyllables(word):
     if len(word) <= 3:
         return 1
 
-    word = re.sub(r"(es|ed|(?<!l)e)$", "", word)
-    return len(re.findall(r"[aeiouy]+", word))
+    word = SUFFIX_RE.sub("", word)
+    return len(VOWELS_RE.findall(word))
 
 
 def normalizeText(text):
-    terminators = ".!?:;"
-    term = re.escape(terminators)
-    text = re.sub(r"[^%s\sA-Za-z]+" % term, "", text)
-    text = re.sub(r"\s*([%s]+\s*)+" % term, ". ", text)
-    return re.sub(r"\s+", " ", text)
+    text = NON_TEXT_RE.sub("", text)
+    text = TERMINATOR_RE.sub(". ", text)
 
+    # Collapse whitespace like re.sub(r"\s+", " ", text), which is much slower
+    collapsed = " ".join(text.split())
+    if not collapsed:
+        return " " if text else ""
+    lead = " " if text[0].isspace() else ""
+    trail = " " if text[-1].isspace() else ""
+    return lead + collapsed + trail
 
-def text_stats(text, wc):
-    text = normalizeText(text)
-    stcs = [s.split(" ") for s in text.split(". ")]
-    stcs = [s for s in stcs if len(s) >= 2]
 
-    if wc:
-        words = wc
-    else:
-        words = sum(len(s) for s in stcs)
+def text_stats(text, wc):
+    sentences = normalizeText(text).split(". ")
+    # Sentences of fewer than two words don't count
+    short = [s for s in sentences if " " not in s]
+    words = " ".join(sentences).split(" ")
 
-    sbls = sum(countSyllables(w) for s in stcs for w in s)
-    return TextStats(len(stcs), words, sbls)
+    stcs = len(sentences) - len(short)
+    sbls = sum(map(countSyllables, words)) - sum(map(countSyllables, short))
+    return TextStats(stcs, wc or (len(words) - len(short)), sbls)
 
 # Adadpted from here: http://acdx.net/calculating-the-flesch-kincaid-level-in-python/
 # See here for details: http://en.wikipedia.org/wiki/Flesch%E2%80%93Kincaid_readability_test
@@ -147,3 +773,133 @@ def flesch_kincaid_level(stats):
     if stats.stcs == 0 or stats.words == 0:
         return 0
     return 0.39 * (stats.words / stats.stcs) + 11.8 * (stats.syllables / stats.words) - 15.59
+
+
+def scoreStats(stats):
+    return {
+        'fi': f"{flesch_index(stats):.2f}",
+        'fk': f"{flesch_kincaid_level(stats):.2f}",
+    }
+
+
+# What text_stats makes of each character, once non-text is dropped;
+# letters are LETTER or up, and lowercase vowels are told apart for syllables
+OTHER, SPACE, TERMINATOR, LETTER, VOWEL = range(5)
+# Words of a run are numbered after the separators ahead of them
+WORD, SPACES, STOP, DOCUMENT = range(4)
+
+
+@functools.lru_cache(maxsize=1)
+def charClasses():
+    """A table of the class of every code point"""
+    classes = numpy.zeros(0x110000, dtype=numpy.uint8)
+    # Whitespace for \s and str.split; there's none past U+3000
+    classes[[c for c in range(0x3001) if chr(c).isspace()]] = SPACE
+    classes[[ord(c) for c in ".!?:;"]] = TERMINATOR
+    classes[[ord(c) for c in "ABCDEFGHIJKLMNOPQRSTUVWXYZbcdfghjklmnpqrstvwxz"]] = LETTER
+    classes[[ord(c) for c in "aeiouy"]] = VOWEL
+    return classes
+
+
+def batchReadability(texts, wcs):
+    """
+    The readability scores of each of `texts`, as getReadability would give
+    them, counted for all of them at once with numpy.
+
+    normalizeText turns each run of letters into a word, each run of spaces
+    into " " and each run of spaces and terminators with a terminator in it
+    into ". ". text_stats then splits sentences at ". " and words at " ",
+    so each separator run ends a piece, and each document has one more
+    piece than it has separator runs: a word, or "" where a document starts
+    or ends with a separator. That's what's counted here, over the code
+    points of all texts at once.
+    """
+    if not (texts and loadNumpy()):
+        return [scoreStats(text_stats(text, wc)) for text, wc in zip(texts, wcs)]
+
+    n = len(texts)
+    codes = numpy.frombuffer("".join(texts).encode('utf-32-le', 'surrogatepass'), dtype=numpy.uint32)
+    classes = charClasses()[codes]
+
+    # Drop what NON_TEXT_RE drops, and find where each document starts after that
+    keep = classes != OTHER
+    kept = numpy.flatnonzero(keep)
+    classes = classes[keep]
+    offsets = numpy.concatenate(([0], numpy.cumsum([len(text) for text in texts])))
+    doc_starts = numpy.searchsorted(kept, offsets[:-1])
+
+    if not len(classes):
+        return [scoreStats(text_stats(text, wc)) for text, wc in zip(texts, wcs)]
+
+    # Runs of letters and of separators, within each document
+    is_letter = classes >= LETTER
+    starts = numpy.ones(len(classes), dtype=bool)
+    starts[1:] = is_letter[1:] != is_letter[:-1]
+    starts[doc_starts[doc_starts < len(classes)]] = True
+    run_start = numpy.flatnonzero(starts)
+    run_end = numpy.append(run_start, len(classes))[1:]
+    run_of = numpy.cumsum(starts, dtype=numpy.int32) - 1
+    runs = len(run_start)
+    first_run = numpy.searchsorted(run_start, doc_starts)
+    run_doc = numpy.repeat(numpy.arange(n), numpy.diff(numpy.append(first_run, runs)))
+    is_word = is_letter[run_start]
+    is_stop = numpy.zeros(runs, dtype=bool)
+    is_stop[run_of[classes == TERMINATOR]] = True
+
+    # Syllables as countSyllables counts them: runs of lowercase vowels, not
+    # counting an "e" the suffix (es|ed|(?<!l)e)$ takes off, and 1 for words
+    # of up to 3 letters
+    vowel = classes == VOWEL
+    vowel_start = vowel.copy()
+    vowel_start[1:] &= ~vowel[:-1] | starts[1:]
+    syllables = numpy.bincount(run_of[vowel_start], minlength=runs)
+    word_runs = numpy.flatnonzero(is_word)
+    word_end = run_end[word_runs]
+    last = codes[kept[word_end - 1]]
+    second = codes[kept[numpy.maximum(word_end - 2, 0)]]
+    strip = numpy.where(
+        (second == ord("e")) & ((last == ord("s")) | (last == ord("d"))), 2,
+        numpy.where((last == ord("e")) & (second != ord("l")), 1, 0)
+    )
+    stripped = (strip > 0) & vowel_start[word_end - numpy.maximum(strip, 1)]
+    syllables[word_runs] = numpy.where(word_end - run_start[word_runs] <= 3, 1, syllables[word_runs] - stripped)
+
+    # A piece starts each document and follows each separator run: the
+    # next word, or ""
+    seps = numpy.flatnonzero(~is_word)
+    after = numpy.minimum(seps + 1, runs - 1)
+    word_after = (seps + 1 < runs) & is_word[after] & (run_doc[after] == run_doc[seps])
+    first = numpy.minimum(first_run, runs - 1)
+    word_first = (first_run < runs) & is_word[first] & (run_doc[first] == numpy.arange(n))
+    piece_doc = numpy.concatenate((numpy.arange(n), run_doc[seps]))
+    piece_syllables = numpy.concatenate((
+        numpy.where(word_first, syllables[first], 1),
+        numpy.where(word_after, syllables[after], 1),
+    ))
+
+    # Documents and stops start sentences
+    stops = numpy.concatenate(([0], numpy.cumsum(is_stop, dtype=numpy.int32)))
+    piece_sentence = numpy.concatenate((
+        stops[first_run] + numpy.arange(n),
+        stops[seps + 1] + run_doc[seps],
+    ))
+    sentence_pieces = numpy.bincount(piece_sentence)
+    sentence_syllables = numpy.bincount(piece_sentence, weights=piece_syllables)
+    sentence_doc = numpy.zeros(len(sentence_pieces), dtype=numpy.int64)
+    sentence_doc[piece_sentence] = piece_doc
+
+    # Sentences of fewer than two words don't count, nor do their words
+    counted = sentence_pieces >= 2
+    stcs = numpy.bincount(sentence_doc, weights=counted, minlength=n).astype(numpy.int64)
+    words = numpy.bincount(sentence_doc, weights=sentence_pieces * counted, minlength=n).astype(numpy.int64)
+    sbls = numpy.bincount(sentence_doc, weights=sentence_syllables * counted, minlength=n).astype(numpy.int64)
+    words = numpy.where(numpy.array(wcs, dtype=numpy.int64) != 0, wcs, words)
+
+    scored = (stcs != 0) & (words != 0)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        per_sentence = words / stcs
+        per_word = sbls / words
+        fi = numpy.where(scored, 206.835 - 1.015 * per_sentence - 84.6 * per_word, 0)
+        fk = numpy.where(scored, 0.39 * per_sentence + 11.8 * per_word - 15.59, 0)
+
+    return [{'fi': f"{a:.2f}", 'fk': f"{b:.2f}"} for a, b in zip(fi.tolist(), fk.tolist())]